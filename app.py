@@ -1,6 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, abort, flash
+from flask import (Flask, render_template, stream_template, request, redirect, url_for, abort, flash, jsonify,
+                   send_file, session, make_response)
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
+from markupsafe import Markup
 
 import requests
 
@@ -10,22 +12,62 @@ import smtplib
 
 from functools import wraps
 
+import click
+
 from flask_ckeditor import CKEditor
-from sqlalchemy import desc
-from sqlalchemy.orm import relationship
-from sqlalchemy.orm.session import make_transient
+from sqlalchemy import desc, func, case, select, insert, update, delete, and_, or_, event, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import relationship, selectinload, joinedload, column_property, aliased, undefer, Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import CreateIndex, AddConstraint
 
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 
 import os
 
+import atexit
+import hashlib
+import hmac
+import io
+import json
+import mimetypes
+import queue
+import select as select_module
 import random
+import re
+import secrets
+import shutil
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+try:
+    from PIL import Image
+except ImportError:
+    # uploaded images are then always served at their original size
+    Image = None
 
-all_colors = os.listdir('static/assets/images/board_background_img/bg_colors/')
+try:
+    import fcntl
+except ImportError:
+    # windows, the catalog refresh is then only shared between the threads of one process
+    fcntl = None
 
-all_images = []
+all_colors = tuple(sorted(os.listdir('static/assets/images/board_background_img/bg_colors/')))
 
 Access_key = os.environ['UNSPLASH_ACCESS_KEY']
 
@@ -40,30 +82,9 @@ parameters = {
 }
 unsplash_url = 'https://api.unsplash.com/photos/random/'
 
-try:
-    response = requests.get(unsplash_url, headers=headers, params=parameters)
-except requests.exceptions.RequestException:
-    try:
-        with open('unsplash_image_links.txt', 'r') as file:
-            all_images = file.read().splitlines()
-    except FileNotFoundError:
-        pass
-
-else:
-    with open('unsplash_image_links.txt', mode='w') as file:
-        for url_index in range(len(response.json())):
-            file.write(response.json()[url_index]["urls"]["regular"] + '&w=1920\n')
-            all_images.append(response.json()[url_index]["urls"]["regular"] + '&w=1920')
-
 logo_colors = ['#CADBC0', '#2F0A28', '#E1DD8F', '#E0777D', '#477890',
                '#E56B70', '#339989', '#FB8824', '#E63946', '#4F345A']
 
-otp_send = False
-otp_confirmed = False
-OTP = ''
-user_forgot_email = ''
-
-current_workspace_id = None
 app = Flask(__name__)
 
 app.config['CKEDITOR_SERVE_LOCAL'] = True
@@ -73,22 +94,202 @@ ckeditor = CKEditor(app)
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_TRACK_MODIFICATION'] = False
+
+# connection pool of every worker, at most DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW connections each
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+app.config['DATABASE_POOL_TIMEOUT'] = int(os.environ.get('DATABASE_POOL_TIMEOUT', 30))  # seconds to wait for one
+app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', 30 * 60))  # seconds, -1 never
+app.config['DATABASE_POOL_PRE_PING'] = os.environ.get('DATABASE_POOL_PRE_PING', 'true').lower() == 'true'
+app.config['DATABASE_STATEMENT_TIMEOUT'] = int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', 0))  # ms, 0 none
+# behind pgbouncer in transaction mode: it does the pooling and startup options are refused, LISTEN needs
+# BOARD_EVENTS_BROKER=local or a session pooled DATABASE_URL
+app.config['DATABASE_PGBOUNCER'] = os.environ.get('DATABASE_PGBOUNCER', 'false').lower() == 'true'
+
+
+def engine_options(url):
+    options = {'pool_pre_ping': app.config['DATABASE_POOL_PRE_PING']}
+    if url.startswith('sqlite'):
+        return options
+    if app.config['DATABASE_PGBOUNCER']:
+        options['poolclass'] = NullPool
+        return options
+
+    # lifo leaves the connections not needed after a burst idle, so the recycle can close them
+    options.update(pool_size=app.config['DATABASE_POOL_SIZE'], max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+                   pool_timeout=app.config['DATABASE_POOL_TIMEOUT'], pool_recycle=app.config['DATABASE_POOL_RECYCLE'],
+                   pool_use_lifo=True)
+    if app.config['DATABASE_STATEMENT_TIMEOUT'] and url.startswith('postgres'):
+        options['connect_args'] = {'options': f"-c statement_timeout={app.config['DATABASE_STATEMENT_TIMEOUT']}"}
+    return options
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 db = SQLAlchemy(app)
 
-# global variable for directory to upload files
-app.config['CARD_ATTACHMENTS'] = 'static/all_uploads/card_attachments/'
-app.config['CARD_COVER_IMAGE'] = 'static/all_uploads/card_cover_image/'
+
+def set_local_statement_timeout(connection):
+    connection.exec_driver_sql(f"SET LOCAL statement_timeout = {app.config['DATABASE_STATEMENT_TIMEOUT']}")
+
+
+with app.app_context():
+    if (app.config['DATABASE_PGBOUNCER'] and app.config['DATABASE_STATEMENT_TIMEOUT'] and
+            db.engine.dialect.name == 'postgresql'):
+        # per transaction, a session setting would stay on the server connection for the next client
+        event.listen(db.engine, 'begin', set_local_statement_timeout)
+
+# upload limits
 app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024  # 8 Megabytes
 app.config['ALLOWED_EXTENSIONS_COVER_IMG'] = ['.jpg', '.jpeg', '.png', '.gif']
 app.config['ALLOWED_EXTENSIONS_CARD_ATTACHMENT'] = ['.jpg', '.jpeg', '.png', '.gif', '.docx', '.pdf', '.html', '.txt']
 
+# attachments and covers are stored once per content hash, 'local' under ATTACHMENT_ROOT or 's3' in a bucket
+app.config['ATTACHMENT_STORAGE'] = os.environ.get('ATTACHMENT_STORAGE', 'local')
+app.config['ATTACHMENT_ROOT'] = 'uploads/objects/'  # outside static/, downloads go through attachment_file
+app.config['ATTACHMENT_STAGING'] = 'upload_staging/'  # uploads in progress, never served
+app.config['ATTACHMENT_BUCKET'] = os.environ.get('ATTACHMENT_BUCKET')
+app.config['ATTACHMENT_S3_ENDPOINT'] = os.environ.get('ATTACHMENT_S3_ENDPOINT')  # minio, moto server...
+app.config['ATTACHMENT_CHUNK_SIZE'] = 1024 * 1024
+app.config['ATTACHMENT_MAX_SIZE'] = 64 * 1024 * 1024  # resumable uploads, sent in MAX_CONTENT_LENGTH pieces
+app.config['ATTACHMENT_UPLOAD_TTL'] = 24 * 60 * 60  # seconds before an unfinished upload is dropped
+
+# files of deleted attachments are removed by a background reaper once the delete commits
+app.config['FILE_REAPER_BATCH_SIZE'] = 100
+app.config['FILE_REAPER_GRACE'] = 10 * 60  # seconds a file reused by an upload is kept before it is checked again
+
+# uploaded covers and images get webp variants of these widths, made by IMAGE_WORKERS background threads
+app.config['IMAGE_VARIANT_WIDTHS'] = (300, 600)
+app.config['IMAGE_VARIANT_EXTENSIONS'] = ['.jpg', '.jpeg', '.png']  # gifs keep their animation
+app.config['IMAGE_VARIANT_QUALITY'] = 80
+app.config['IMAGE_WORKERS'] = 2
+
+# attachment downloads are sent by the front proxy when one is configured: USE_X_SENDFILE for apache/lighttpd,
+# ATTACHMENT_ACCEL_REDIRECT (the internal nginx location of ATTACHMENT_ROOT) for nginx
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'false').lower() == 'true'
+app.config['ATTACHMENT_ACCEL_REDIRECT'] = os.environ.get('ATTACHMENT_ACCEL_REDIRECT')
+app.config['ATTACHMENT_MAX_AGE'] = 365 * 24 * 60 * 60  # seconds, a key never changes content
+app.config['ATTACHMENT_LINK_TTL'] = 5 * 60  # seconds a presigned s3 download link stays valid
+
+# rank keys of lists and cards longer than this get rebalanced in the background
+app.config['RANK_MAX_LENGTH'] = 8
+
+# outgoing mail, delivered by background workers
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() == 'true'
+app.config['MAIL_WORKERS'] = 2
+app.config['MAIL_BATCH_SIZE'] = 20
+app.config['MAIL_RETRIES'] = 4
+app.config['MAIL_RETRY_DELAY'] = 2  # seconds, doubled on every retry
+app.config['MAIL_IDLE_TIMEOUT'] = 60  # seconds before an unused smtp connection is closed
+
+# boards opened are written to board_recent_open_time at most once per interval
+app.config['RECENT_OPEN_FLUSH_INTERVAL'] = 30  # seconds
+
+# an open event stream holds a worker thread for each board tab, only turn it on with an async worker class
+# (gunicorn -k gevent), without it board.html polls the board's etag every BOARD_EVENTS_POLL_INTERVAL and no
+# change events are collected at all
+app.config['BOARD_EVENTS_STREAM'] = os.environ.get('BOARD_EVENTS_STREAM', 'false').lower() == 'true'
+# 'postgres' shares board change events between workers with LISTEN/NOTIFY, 'local' keeps them in the process
+app.config['BOARD_EVENTS_BROKER'] = os.environ.get(
+    'BOARD_EVENTS_BROKER', 'postgres' if app.config['BOARD_EVENTS_STREAM'] and
+    os.environ['DATABASE_URL'].startswith('postgres') else 'local')
+app.config['BOARD_EVENTS_STREAM_TIMEOUT'] = 50  # seconds before a stream is closed, the browser reconnects
+app.config['BOARD_EVENTS_POLL_INTERVAL'] = 30  # seconds
+
+# rendered list columns of board.html, RENDER_CACHE_URL (redis://...) shares them between workers
+app.config['RENDER_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['RENDER_CACHE_URL'] = os.environ.get('RENDER_CACHE_URL')
+app.config['RENDER_CACHE_TTL'] = 24 * 60 * 60  # seconds
+
+# board and boards manager pages are sent while they render
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES', 'true').lower() == 'true'
+app.config['STREAM_BUFFER_SIZE'] = 8 * 1024  # characters per write
+
+# unsplash board backgrounds, served from the cache file and refreshed in the background
+app.config['UNSPLASH_CACHE_FILE'] = 'unsplash_image_links.txt'
+app.config['UNSPLASH_CACHE_TTL'] = 6 * 60 * 60  # seconds
+app.config['UNSPLASH_TIMEOUT'] = 5  # seconds
+app.config['UNSPLASH_RETRY_DELAY'] = 5 * 60  # seconds between two refresh attempts of a worker
+
+# short lived server-side state (password resets, counters), kept in the database unless STATE_STORE_URL is
+# redis://... or memory:// (in-process, only for a single worker process)
+app.config['STATE_STORE_URL'] = os.environ.get('STATE_STORE_URL')
+app.config['STATE_STORE_SIZE'] = 16384  # keys kept by the in-process store
+
+# password reset codes, kept hashed in the state store
+app.config['OTP_TTL'] = 10 * 60  # seconds
+app.config['OTP_ATTEMPTS'] = 5
+app.config['OTP_SENDS'] = 3  # codes mailed to one address per OTP_TTL
+
+# users restored from the session cookie are kept in memory, a password change is seen within the ttl everywhere
+app.config['USER_CACHE_SIZE'] = 4096
+app.config['USER_CACHE_TTL'] = 60  # seconds
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 
+# --------------------------------------- User Session Cache ----------------------------------------- #
+
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+
+
+class CachedUser(UserMixin):
+    # the columns the pages read from current_user, without the relationships of User
+    def __init__(self, user):
+        self.id = user.id
+        self.user_name = user.user_name
+        self.user_email = user.user_email
+        self.user_logo_color = user.user_logo_color
+        self.password_stamp = password_stamp(user)
+
+    def __repr__(self):
+        return f'<User {self.user_name}>'
+
+
+def password_stamp(user):
+    # kept in the session at login, a session from before a password change no longer matches
+    return hashlib.sha256(user.user_password.encode()).hexdigest()[:16]
+
+
+def cached_user(user_id):
+    now = time.monotonic()
+    with user_cache_lock:
+        cached = user_cache.get(user_id)
+        if cached and cached[0] > now:
+            user_cache.move_to_end(user_id)
+            return cached[1]
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        forget_user(user_id)
+        return None
+
+    cached = CachedUser(user)
+    with user_cache_lock:
+        user_cache[user_id] = (now + app.config['USER_CACHE_TTL'], cached)
+        user_cache.move_to_end(user_id)
+        while len(user_cache) > app.config['USER_CACHE_SIZE']:
+            user_cache.popitem(last=False)
+    return cached
+
+
+def forget_user(user_id):
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    user = cached_user(int(user_id))
+    if user is None:
+        return None
+    # sessions from before the stamp was kept take the current one
+    if session.setdefault('password_stamp', user.password_stamp) != user.password_stamp:
+        return None
+    return user
 
 
 # --------------------------------------- Databases ----------------------------------------- #
@@ -114,6 +315,7 @@ class User(UserMixin, db.Model):
 
 class Workspace(db.Model):
     __tablename__ = "workspaces"
+    __table_args__ = (db.Index('ix_workspaces_creator_id', 'creator_id', 'workspace_id'),)
     workspace_id = db.Column(db.Integer, primary_key=True, nullable=False)
     workspace_name = db.Column(db.String(20), nullable=False)
     workspace_description = db.Column(db.String(250), nullable=True)
@@ -123,7 +325,9 @@ class Workspace(db.Model):
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     workspace_creator = relationship("User", back_populates="user_workspaces")
 
-    workspace_boards = relationship("Board", back_populates="parent_workspace")
+    # children go with their parent, the database deletes the ones not loaded (ON DELETE CASCADE)
+    workspace_boards = relationship("Board", back_populates="parent_workspace", cascade="save-update, merge, delete",
+                                    passive_deletes=True)
 
     def __repr__(self):
         return f'<Workspace {self.workspace_name}>'
@@ -131,6 +335,10 @@ class Workspace(db.Model):
 
 class Board(db.Model):
     __tablename__ = "boards"
+    __table_args__ = (db.Index('ix_boards_creator_recent', 'creator_id', 'is_template', 'board_recent_open_time'),
+                      db.Index('ix_boards_creator_added', 'creator_id', 'is_template', 'board_added_date'),
+                      db.Index('ix_boards_workspace', 'parent_workspace_id', 'is_template'),
+                      db.Index('ix_boards_is_template', 'is_template'))
     board_id = db.Column(db.Integer, primary_key=True, nullable=False)
     board_name = db.Column(db.String(20), nullable=False)
     board_visibility = db.Column(db.String(20), nullable=False, default='workspace')
@@ -139,14 +347,18 @@ class Board(db.Model):
     board_favorite = db.Column(db.Boolean, nullable=False, default=False)
     board_added_date = db.Column(db.DateTime, nullable=False)
     is_template = db.Column(db.Boolean, default=False, nullable=False)
+    # bumped on every change of the board or its lists, cards, items and attachments, the api etags use it
+    board_version = db.Column(db.Integer, nullable=False, default=0)
 
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     board_creator = relationship("User", back_populates="user_boards")
 
-    parent_workspace_id = db.Column(db.Integer, db.ForeignKey('workspaces.workspace_id'), nullable=False)
+    parent_workspace_id = db.Column(db.Integer, db.ForeignKey('workspaces.workspace_id', ondelete='CASCADE'),
+                                    nullable=False)
     parent_workspace = relationship("Workspace", back_populates="workspace_boards")
 
-    board_lists = relationship("List", back_populates="parent_board")
+    board_lists = relationship("List", back_populates="parent_board", cascade="save-update, merge, delete",
+                               passive_deletes=True)
 
     def __repr__(self):
         return f'<Board {self.board_name}>'
@@ -154,17 +366,19 @@ class Board(db.Model):
 
 class List(db.Model):
     __tablename__ = "lists"
+    __table_args__ = (db.Index('ix_lists_board_rank', 'parent_board_id', 'list_rank', 'list_id'),)
     list_id = db.Column(db.Integer, primary_key=True, nullable=False)
     list_name = db.Column(db.String(25), nullable=False)
-    list_position = db.Column(db.Integer, nullable=False)
+    list_rank = db.Column(db.String(64), nullable=False)
 
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     list_creator = relationship("User", back_populates="user_lists")
 
-    parent_board_id = db.Column(db.Integer, db.ForeignKey('boards.board_id'), nullable=False)
+    parent_board_id = db.Column(db.Integer, db.ForeignKey('boards.board_id', ondelete='CASCADE'), nullable=False)
     parent_board = relationship("Board", back_populates="board_lists")
 
-    list_cards = relationship("Card", back_populates="parent_list")
+    list_cards = relationship("Card", back_populates="parent_list", order_by="[Card.card_rank, Card.card_id]",
+                              cascade="save-update, merge, delete", passive_deletes=True)
 
     def __repr__(self):
         return f'<List {self.list_name}>'
@@ -172,9 +386,10 @@ class List(db.Model):
 
 class Card(db.Model):
     __tablename__ = "cards"
+    __table_args__ = (db.Index('ix_cards_list_rank', 'parent_list_id', 'card_rank', 'card_id'),)
     card_id = db.Column(db.Integer, primary_key=True, nullable=False)
     card_name = db.Column(db.String(20), nullable=False)
-    card_position = db.Column(db.Integer, nullable=False)
+    card_rank = db.Column(db.String(64), nullable=False)
     card_description = db.Column(db.String(500), nullable=True)
     card_dueDate = db.Column(db.Date(), nullable=True)
     card_checklist_name = db.Column(db.String(20), nullable=True)
@@ -183,11 +398,15 @@ class Card(db.Model):
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     card_creator = relationship("User", back_populates="user_cards")
 
-    parent_list_id = db.Column(db.Integer, db.ForeignKey('lists.list_id'), nullable=False)
+    parent_list_id = db.Column(db.Integer, db.ForeignKey('lists.list_id', ondelete='CASCADE'), nullable=False)
     parent_list = relationship("List", back_populates="list_cards")
 
-    card_attachments = relationship("Attachment", back_populates="parent_card")
-    card_checklist_items = relationship("ChecklistItem", back_populates="parent_card")
+    card_attachments = relationship("Attachment", back_populates="parent_card",
+                                    order_by="Attachment.attachment_upload_date",
+                                    cascade="save-update, merge, delete", passive_deletes=True)
+    card_checklist_items = relationship("ChecklistItem", back_populates="parent_card",
+                                        order_by="ChecklistItem.item_id",
+                                        cascade="save-update, merge, delete", passive_deletes=True)
 
     def __repr__(self):
         return f'<Card {self.card_name}>'
@@ -195,17 +414,20 @@ class Card(db.Model):
 
 class Attachment(db.Model):
     __tablename__ = "attachments"
+    __table_args__ = (db.Index('ix_attachments_card_cover', 'parent_card_id', 'is_cover_image'),)
     attachment_id = db.Column(db.Integer, primary_key=True, nullable=False)
     attachment_name = db.Column(db.String(300), nullable=False)
     attachment_extension = db.Column(db.String(20), nullable=False)
     attachment_upload_date = db.Column(db.DateTime(), nullable=False)
     attachment_path = db.Column(db.String(350), nullable=False)
     is_cover_image = db.Column(db.Boolean, nullable=False, default=False)
+    # sha256 of the content and the extension, None for files uploaded before content addressing
+    attachment_key = db.Column(db.String(100), index=True)
 
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     attachment_creator = relationship("User", back_populates="user_attachments")
 
-    parent_card_id = db.Column(db.Integer, db.ForeignKey('cards.card_id'), nullable=False)
+    parent_card_id = db.Column(db.Integer, db.ForeignKey('cards.card_id', ondelete='CASCADE'), nullable=False)
     parent_card = relationship("Card", back_populates="card_attachments")
 
     def __repr__(self):
@@ -214,6 +436,7 @@ class Attachment(db.Model):
 
 class ChecklistItem(db.Model):
     __tablename__ = "checklist_items"
+    __table_args__ = (db.Index('ix_checklist_items_card', 'parent_card_id', 'item_id'),)
     item_id = db.Column(db.Integer, primary_key=True, nullable=False)
     item_name = db.Column(db.String(15), nullable=False)
     item_status = db.Column(db.Boolean, nullable=False)
@@ -221,13 +444,59 @@ class ChecklistItem(db.Model):
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     item_creator = relationship("User", back_populates="user_items")
 
-    parent_card_id = db.Column(db.Integer, db.ForeignKey('cards.card_id'), nullable=False)
+    parent_card_id = db.Column(db.Integer, db.ForeignKey('cards.card_id', ondelete='CASCADE'), nullable=False)
     parent_card = relationship("Card", back_populates="card_checklist_items")
 
     def __repr__(self):
         return f'<ChecklistItem {self.item_name}>'
 
 
+class SchemaVersion(db.Model):
+    __tablename__ = "schema_versions"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version_name = db.Column(db.String(100), nullable=False)
+    applied_date = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<SchemaVersion {self.version}>'
+
+
+class StateEntry(db.Model):
+    __tablename__ = "state_entries"
+    __table_args__ = (db.Index('ix_state_entries_expires', 'state_expires'),)
+    state_key = db.Column(db.String(200), primary_key=True)
+    state_value = db.Column(db.Text, nullable=True)
+    state_count = db.Column(db.Integer, nullable=False, default=0)
+    state_expires = db.Column(db.Float, nullable=False)  # unix time
+
+    def __repr__(self):
+        return f'<StateEntry {self.state_key}>'
+
+
+# list_position / card_position are the 1-based places shown in the UI, derived from the rank keys
+# deferred, a subquery counting the siblings is only run for a row whose position is read, the board and card loaders
+# fill them in from the (rank, id) order instead
+sibling_list = aliased(List)
+List.list_position = column_property(
+    select(func.count(sibling_list.list_id))
+    .where(sibling_list.parent_board_id == List.parent_board_id,
+           or_(sibling_list.list_rank < List.list_rank,
+               and_(sibling_list.list_rank == List.list_rank, sibling_list.list_id <= List.list_id)))
+    .correlate_except(sibling_list)
+    .scalar_subquery(),
+    deferred=True)
+
+sibling_card = aliased(Card)
+Card.card_position = column_property(
+    select(func.count(sibling_card.card_id))
+    .where(sibling_card.parent_list_id == Card.parent_list_id,
+           or_(sibling_card.card_rank < Card.card_rank,
+               and_(sibling_card.card_rank == Card.card_rank, sibling_card.card_id <= Card.card_id)))
+    .correlate_except(sibling_card)
+    .scalar_subquery(),
+    deferred=True)
+
+
 with app.app_context():
     db.create_all()
 
@@ -244,6 +513,135 @@ def admin_only(f):
     return decorated_function
 
 
+# --------------------------------------- State Store ----------------------------------------- #
+
+
+class MemoryStore:
+    # json values with a ttl in this process only (memory://, a single worker), least recently used keys are evicted
+    # past max_size
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def live_item(self, key, now):
+        item = self.items.get(key)
+        if item is not None and item[0] <= now:
+            del self.items[key]
+            item = None
+        return item
+
+    def store_item(self, key, expires, value):
+        self.items[key] = (expires, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            item = self.live_item(key, time.time())
+            if item is None:
+                return None
+            self.items.move_to_end(key)
+            return json.loads(item[1])
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.store_item(key, time.time() + ttl, json.dumps(value))
+
+    def incr(self, key, ttl):
+        # the ttl starts with the first increment, like a fixed rate limit window
+        with self.lock:
+            now = time.time()
+            item = self.live_item(key, now)
+            expires, count = (item[0], json.loads(item[1]) + 1) if item else (now + ttl, 1)
+            self.store_item(key, expires, json.dumps(count))
+            return count
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class RedisStore:
+    # a redis compatible server shared by every worker and node, unlike the render cache its errors are not hidden
+
+    def __init__(self, url):
+        self.server = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.server.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self.server.set(key, json.dumps(value), ex=ttl)
+
+    def incr(self, key, ttl):
+        pipeline = self.server.pipeline()
+        pipeline.set(key, 0, ex=ttl, nx=True)
+        pipeline.incr(key)
+        return pipeline.execute()[1]
+
+    def delete(self, key):
+        self.server.delete(key)
+
+
+class DatabaseStore:
+    # the state_entries table, shared by every worker, each call runs in its own short transaction so it never
+    # commits or rolls back the request's session
+
+    def get(self, key):
+        with db.engine.begin() as connection:
+            value = connection.scalar(select(StateEntry.state_value).where(StateEntry.state_key == key,
+                                                                          StateEntry.state_expires > time.time()))
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with db.engine.begin() as connection:
+            # expired entries are dropped here, sets are rare next to reads
+            connection.execute(delete(StateEntry).where(or_(StateEntry.state_key == key,
+                                                            StateEntry.state_expires <= now)))
+            connection.execute(insert(StateEntry).values(state_key=key, state_value=json.dumps(value),
+                                                         state_expires=now + ttl))
+
+    def incr(self, key, ttl):
+        # the write comes first, it locks the row (the database on sqlite) so parallel increments queue up
+        while True:
+            now = time.time()
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(delete(StateEntry).where(StateEntry.state_key == key,
+                                                                StateEntry.state_expires <= now))
+                    if connection.execute(update(StateEntry).where(StateEntry.state_key == key)
+                                           .values(state_count=StateEntry.state_count + 1)).rowcount:
+                        return connection.scalar(select(StateEntry.state_count).where(StateEntry.state_key == key))
+                    connection.execute(insert(StateEntry).values(state_key=key, state_count=1,
+                                                                 state_expires=now + ttl))
+                    return 1
+            except IntegrityError:
+                # another worker opened the window first, counted on the next pass
+                continue
+
+    def delete(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(delete(StateEntry).where(StateEntry.state_key == key))
+
+
+def state_store_for(url):
+    if not url:
+        return DatabaseStore()
+    if url == 'memory://':
+        return MemoryStore(app.config['STATE_STORE_SIZE'])
+    if redis is None:
+        raise RuntimeError('STATE_STORE_URL needs redis installed')
+    return RedisStore(url)
+
+
+state_store = state_store_for(app.config['STATE_STORE_URL'])
+
+
 # --------------------------------------- Otp generator ----------------------------------------- #
 
 
@@ -253,27 +651,40 @@ def generate_otp():
     letters_up = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T',
                   'U', 'V', 'W', 'X', 'Y', 'Z']
 
-    up_letters_list = [random.choice(letters_up) for _ in range(2)]
-    numbers_list = [random.choice(numbers) for _ in range(4)]
+    up_letters_list = [secrets.choice(letters_up) for _ in range(2)]
+    numbers_list = [secrets.choice(numbers) for _ in range(4)]
 
     otp_letters = up_letters_list + numbers_list
-    random.shuffle(otp_letters)
+    secrets.SystemRandom().shuffle(otp_letters)
     otp_email = "".join(otp_letters)
     return otp_email
 
 
 # --------------------------------------- SMTP email sender ----------------------------------------- #
 
+mail_outbox = queue.Queue()
+mail_workers = []
+mail_workers_lock = threading.Lock()
+
+
+def otp_digest(otp):
+    # keyed, so a dump of the state store does not give away the codes still valid
+    return hmac.new(app.config['SECRET_KEY'].encode(), otp.upper().encode(), hashlib.sha256).hexdigest()
+
 
 def send_otp(email):
-    global OTP
+    # starts a password reset and returns its token, None once the address had OTP_SENDS codes in OTP_TTL
+    if state_store.incr(f'otp_sends:{email}', app.config['OTP_TTL']) > app.config['OTP_SENDS']:
+        return None
+
     sender = os.environ['ADMIN_EMAIL']
     receivers = email
-    password = os.environ['EMAIL_APP_PASSWORD']
-    # (generated by App Password in google security settings)
-    OTP = generate_otp()
+    otp = generate_otp()
+    token = secrets.token_urlsafe(16)
+    state_store.set(f'password_reset:{token}', {'email': email, 'otp': otp_digest(otp), 'confirmed': False},
+                    app.config['OTP_TTL'])
 
-    content = f"To authenticate, please use the following One Time Password(OTP):\n {OTP}\n Don't" \
+    content = f"To authenticate, please use the following One Time Password(OTP):\n {otp}\n Don't" \
               f" share this OTP with anyone. Our customer service team will never ask you for your" \
               f" password, OTP, credit card, or banking info.\n We hope to see you again soon."
 
@@ -284,12 +695,155 @@ def send_otp(email):
 
     message.attach(MIMEText(content, "plain"))
 
-    session = smtplib.SMTP("smtp.gmail.com", 587)
-    session.starttls()
-    session.login(sender, password)
-    text = message.as_string()
-    session.sendmail(sender, receivers, text)
-    session.quit()
+    queue_mail(sender, receivers, message.as_string())
+    return token
+
+
+def queue_mail(sender, receivers, text):
+    # returns at once, the mail is sent by a worker thread
+    start_mail_workers()
+    mail_outbox.put((sender, receivers, text, 0))
+
+
+def start_mail_workers():
+    # started on first use so every gunicorn worker process gets its own threads
+    with mail_workers_lock:
+        if not mail_workers:
+            for _ in range(app.config['MAIL_WORKERS']):
+                worker = threading.Thread(target=deliver_mail, daemon=True)
+                worker.start()
+                mail_workers.append(worker)
+
+
+def open_smtp_session():
+    session = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=30)
+    if app.config['MAIL_USE_TLS']:
+        session.starttls()
+    # (generated by App Password in google security settings)
+    password = os.environ.get('EMAIL_APP_PASSWORD')
+    if password:
+        session.login(os.environ['ADMIN_EMAIL'], password)
+    return session
+
+
+def close_smtp_session(session):
+    try:
+        session.quit()
+    except (smtplib.SMTPException, OSError):
+        session.close()
+
+
+def retry_mail(mail):
+    mail_outbox.put(mail)
+    mail_outbox.task_done()
+
+
+def deliver_mail():
+    # one worker: keeps its smtp session open between mails and sends whatever is queued in one go
+    session = None
+    while True:
+        try:
+            batch = [mail_outbox.get(timeout=app.config['MAIL_IDLE_TIMEOUT'])]
+        except queue.Empty:
+            if session:
+                close_smtp_session(session)
+                session = None
+            continue
+
+        while len(batch) < app.config['MAIL_BATCH_SIZE']:
+            try:
+                batch.append(mail_outbox.get_nowait())
+            except queue.Empty:
+                break
+
+        for sender, receivers, text, attempt in batch:
+            try:
+                if session is None:
+                    session = open_smtp_session()
+                session.sendmail(sender, receivers, text)
+            except (smtplib.SMTPException, OSError) as error:
+                if session:
+                    session.close()
+                    session = None
+                if attempt < app.config['MAIL_RETRIES']:
+                    delay = app.config['MAIL_RETRY_DELAY'] * 2 ** attempt
+                    threading.Timer(delay, retry_mail, args=((sender, receivers, text, attempt + 1),)).start()
+                    continue
+                app.logger.error(f'mail to {receivers} dropped after {attempt + 1} attempts: {error}')
+            mail_outbox.task_done()
+
+
+# --------------------------------------- Unsplash background catalog ----------------------------------------- #
+
+background_catalog = {'images': (), 'mtime': None, 'refreshing': False, 'attempted': 0}
+background_catalog_lock = threading.Lock()
+
+
+def background_images():
+    # never waits on the network: reads the cache file when another process has rewritten it and
+    # starts a background refresh once it is older than UNSPLASH_CACHE_TTL
+    cache_file = app.config['UNSPLASH_CACHE_FILE']
+    try:
+        mtime = os.path.getmtime(cache_file)
+    except OSError:
+        mtime = None
+
+    with background_catalog_lock:
+        if mtime is not None and mtime != background_catalog['mtime']:
+            with open(cache_file, 'r') as file:
+                background_catalog['images'] = tuple(file.read().splitlines())
+            background_catalog['mtime'] = mtime
+
+        stale = mtime is None or time.time() - mtime > app.config['UNSPLASH_CACHE_TTL']
+        retry = time.time() - background_catalog['attempted'] > app.config['UNSPLASH_RETRY_DELAY']
+        if stale and retry and not background_catalog['refreshing']:
+            background_catalog['refreshing'] = True
+            background_catalog['attempted'] = time.time()
+            threading.Thread(target=refresh_background_images, daemon=True).start()
+
+        return background_catalog['images']
+
+
+def refresh_background_images():
+    cache_file = app.config['UNSPLASH_CACHE_FILE']
+    try:
+        with open(cache_file + '.lock', 'w') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # another worker is already refreshing
+                    return
+
+            # the file may have been refreshed while this worker was waiting for the lock
+            if (os.path.exists(cache_file) and
+                    time.time() - os.path.getmtime(cache_file) <= app.config['UNSPLASH_CACHE_TTL']):
+                return
+
+            response = requests.get(unsplash_url, headers=headers, params=parameters,
+                                    timeout=app.config['UNSPLASH_TIMEOUT'])
+            response.raise_for_status()
+            images = [photo["urls"]["regular"] + '&w=1920' for photo in response.json()]
+
+            # written next to the cache file and swapped in, readers never see a half written file
+            with open(cache_file + '.tmp', mode='w') as file:
+                file.write(''.join(f'{image}\n' for image in images))
+            os.replace(cache_file + '.tmp', cache_file)
+    except (requests.exceptions.RequestException, ValueError, KeyError, OSError) as error:
+        app.logger.warning(f'unsplash backgrounds not refreshed: {error}')
+    finally:
+        with background_catalog_lock:
+            background_catalog['refreshing'] = False
+
+
+# --------------------------------------- Background picker ----------------------------------------- #
+
+
+def pick_backgrounds(color_count, image_count):
+    # random colors and images for one page, sampled from the shared tuples instead of shuffling them
+    images = background_images()
+    return (random.sample(all_colors, min(color_count, len(all_colors))),
+            random.sample(images, min(image_count, len(images))))
 
 
 # --------------------------------------- Strip data function ----------------------------------------- #
@@ -306,254 +860,1529 @@ def strip_form_data(form):
     return lst
 
 
+# --------------------------------------- Bulk Copy ----------------------------------------- #
+
+
+def copy_rows(model, criteria, parent_column=None, parent_map=None, returning=True, **changes):
+    # copies the matching rows with one SELECT and one batched INSERT, returns {old id: new id} if returning
+    # parent_map moves every copy under the new id of its parent, changes overrides columns of every copy
+    table = model.__table__
+    primary_key = inspect(model).primary_key[0].key
+
+    rows = db.session.execute(select(table).where(criteria).order_by(table.c[primary_key])).mappings().all()
+    if not rows:
+        return {}
+
+    values = []
+    for row in rows:
+        value = {key: row[key] for key in row.keys() if key != primary_key}
+        if parent_column:
+            value[parent_column] = parent_map[row[parent_column]]
+        value.update(changes)
+        values.append(value)
+
+    if not returning:
+        db.session.execute(insert(model), values)
+        return {}
+
+    new_ids = db.session.scalars(insert(model).returning(inspect(model).primary_key[0],
+                                                         sort_by_parameter_order=True), values).all()
+    return dict(zip([row[primary_key] for row in rows], new_ids))
+
+
+def copy_card_contents(card_map):
+    copy_rows(ChecklistItem, ChecklistItem.parent_card_id.in_(card_map), 'parent_card_id', card_map, returning=False)
+    copy_rows(Attachment, Attachment.parent_card_id.in_(card_map), 'parent_card_id', card_map, returning=False)
+
+
+def copy_list_contents(list_map):
+    card_map = copy_rows(Card, Card.parent_list_id.in_(list_map), 'parent_list_id', list_map)
+    copy_card_contents(card_map)
+
+
+def copy_board_contents(board_map):
+    list_map = copy_rows(List, List.parent_board_id.in_(board_map), 'parent_board_id', board_map)
+    copy_list_contents(list_map)
+
+
 # --------------------------------------- Copy Board Row ----------------------------------------- #
 
 
-def copy_board(id_, board_name, workspace_id, background):
-    s = db.session
-    board_ = s.query(Board).get(id_)
-    list_ = None
-    card_ = None
-    ls = None
-    c = None
-    mc1 = None
-    mc2 = None
-
-    for i in range(len(board_.board_lists)):
-        if board_.board_lists:
-            ls = board_.board_lists[i]
-
-            list_ = s.query(List).get(ls.list_id)
-
-            for j in range(len(list_.list_cards)):
-                if list_.list_cards:
-                    c = list_.list_cards[j]
-
-                    card_ = s.query(Card).get(c.card_id)
-
-                    for k in range(len(card_.card_attachments)):
-                        if card_.card_attachments:
-                            mc1 = card_.card_attachments[k]
-
-                            s.expunge(mc1)
-                            make_transient(mc1)
-                            mc1.attachment_id = None
-
-                    for n in range(len(card_.card_checklist_items)):
-                        if card_.card_checklist_items:
-                            mc2 = card_.card_checklist_items[n]
-
-                            s.expunge(mc2)
-                            make_transient(mc2)
-                            mc2.item_id = None
-
-                    s.expunge(c)
-                    make_transient(c)
-                    c.card_id = None
-
-            s.expunge(ls)
-            make_transient(ls)
-            ls.list_id = None
-
-    s.expunge(board_)
-    board_.board_id = None
-    board_.board_name = board_name
-    board_.parent_workspace_id = workspace_id
-    board_.board_background = background
-    board_.board_added_date = datetime.now()
-    board_.recent_open_time = datetime.now()
-    board_.is_template = False
-    board_.creator_id = current_user.id
-
-    make_transient(board_)
-    s.add(board_)
-    s.commit()
-
-    if ls:
-        assert board_.board_id
-        ls.board_id = board_.board_id
-        s.add(ls)
-        s.commit()
-
-    if c:
-        assert list_.list_id
-        c.list_id = list_.list_id
-        s.add(c)
-        s.commit()
-
-    if mc1:
-        assert card_.card_id
-        mc1.attachment_id = card_.card_id
-        s.add(mc1)
-        s.commit()
-
-    if mc2:
-        assert card_.card_id
-        mc2.checklist_id = card_.card_id
-        s.add(mc2)
-        s.commit()
+def copy_board(id_, board_name, workspace_id, background, creator_id):
+    # board, lists, cards, checklist items and attachments: 5 SELECTs and 5 INSERTs, one commit
+    board_map = copy_rows(Board, Board.board_id == id_, board_name=board_name, parent_workspace_id=int(workspace_id),
+                          board_background_image=background, board_added_date=datetime.now(),
+                          board_recent_open_time=datetime.now(), is_template=False, creator_id=creator_id,
+                          board_version=0)
+    copy_board_contents(board_map)
+    db.session.commit()
 
 
 # --------------------------------------- Copy List Row ----------------------------------------- #
 
 
 def clone_list(id_, updated_name):
-    s = db.session
-    agent = s.query(List).get(id_)
-    child = None
-    c = None
-    mc1 = None
-    mc2 = None
-
-    for i in range(len(agent.list_cards)):
-        if agent.list_cards:
-            c = agent.list_cards[i]
-
-            child = s.query(Card).get(c.card_id)
-
-            for j in range(len(child.card_attachments)):
-                if child.card_attachments:
-                    mc1 = child.card_attachments[j]
-                    # db.session.expunge does
-                    s.expunge(mc1)
-
-                    make_transient(mc1)
-                    mc1.attachment_id = None
-
-            for k in range(len(child.card_checklist_items)):
-                if child.card_checklist_items:
-                    mc2 = child.card_checklist_items[k]
-                    # db.session.expunge does
-                    s.expunge(mc2)
-
-                    make_transient(mc2)
-                    mc2.item_id = None
-
-            # db.session.expunge does
-            s.expunge(c)
-            make_transient(c)
-            c.card_id = None
-
-    s.expunge(agent)
-    agent.list_id = None
-    agent.list_name = updated_name
-    agent.list_position = agent.list_position + 1
-
-    make_transient(agent)
-    s.add(agent)
-    s.commit()
-
-    if c:
-        assert agent.list_id
-        c.agent_id = agent.list_id
-        s.add(c)
-        s.commit()
-
-    if mc1:
-        assert child.card_id
-        mc1.child_id = child.card_id
-        s.add(mc1)
-        s.commit()
-
-    if mc2:
-        assert child.card_id
-        mc2.child_id = child.card_id
-        s.add(mc2)
-        s.commit()
+    list_ = List.query.get(id_)
+    # right after the copied list
+    list_map = copy_rows(List, List.list_id == id_, list_name=updated_name,
+                         list_rank=list_rank_at(list_.parent_board_id, list_.list_position + 1))
+    copy_list_contents(list_map)
+    touch_boards(db.session, [list_.parent_board_id])
+    for new_list_id in list_map.values():
+        queue_board_event(db.session, list_.parent_board_id, {'type': 'list.created', 'id': new_list_id})
+    db.session.commit()
 
 
 # --------------------------------------- Copy Card Row ----------------------------------------- #
 
 
-def clone_card(card_id, updated_name, updated_position, updated_parent_id):
-    s = db.session
-    agent = s.query(Card).get(card_id)
-    c1 = None
-    c2 = None
-
-    # card_checklist_items
-    for i in range(len(agent.card_attachments)):
-        if agent.card_attachments:
-            c1 = agent.card_attachments[i]
-            s.expunge(c1)
-            make_transient(c1)
-            c1.attachment_id = None
-
-    for i in range(len(agent.card_checklist_items)):
-        if agent.card_checklist_items:
-            c2 = agent.card_checklist_items[i]
-            s.expunge(c2)
-            make_transient(c2)
-            c2.item_id = None
-
-    s.expunge(agent)
-    agent.card_id = None
-    agent.card_name = updated_name
-    agent.card_position = updated_position
-    agent.parent_list_id = updated_parent_id
-
-    make_transient(agent)
-
-    s.add(agent)
-    s.commit()
-
-    if c1:
-        assert agent.card_id
-        c1.agent_id = agent.card_id
-        s.add(c1)
-        s.commit()
-
-    if c2:
-        assert agent.card_id
-        c2.agent_id = agent.card_id
-        s.add(c2)
-        s.commit()
-
-
-# --------------------------------------- Move List Position ----------------------------------------- #
-
-
-def increase_or_decrease_position(current_position, destination_position, parent_id):
-    if current_position < destination_position:
-        # increase position
-        for i in range(int(current_position) + 1,
-                       int(destination_position) + 1):
-            list_to_edit = List.query.filter_by(list_position=i, parent_board_id=parent_id).first()
-            list_to_edit.list_position = i - 1
-            db.session.commit()
+def clone_card(card_id, updated_name, updated_rank, updated_parent_id):
+    card_map = copy_rows(Card, Card.card_id == card_id, card_name=updated_name, card_rank=updated_rank,
+                         parent_list_id=int(updated_parent_id))
+    copy_card_contents(card_map)
+    board_id = List.query.get(int(updated_parent_id)).parent_board_id
+    touch_boards(db.session, [board_id])
+    for new_card_id in card_map.values():
+        queue_board_event(db.session, board_id, {'type': 'card.created', 'id': new_card_id})
+    db.session.commit()
 
-    elif current_position > destination_position:
-        # decrease position
-        for i in range(-(int(current_position) - 1),
-                       -(int(destination_position) - 1)):
-            # 4, 3, 2
-            i *= -1
-            list_to_edit = List.query.filter_by(list_position=i, parent_board_id=parent_id).first()
-            list_to_edit.list_position = i + 1
-            db.session.commit()
+
+# --------------------------------------- Copy Benchmark ----------------------------------------- #
+
+
+def copy_board_by_instance(id_, creator_id):
+    # the previous copy path, one ORM instance and one flush per row, kept as the benchmark baseline
+    def copy_instance(instance, **changes):
+        copy = type(instance)(**{column.key: getattr(instance, column.key)
+                                 for column in instance.__table__.columns if not column.primary_key})
+        for key, value in changes.items():
+            setattr(copy, key, value)
+        db.session.add(copy)
+        db.session.flush()
+        return copy
+
+    board_ = Board.query.get(id_)
+    new_board = copy_instance(board_, is_template=False, creator_id=creator_id)
+    for list_ in board_.board_lists:
+        new_list = copy_instance(list_, parent_board_id=new_board.board_id)
+        for card_ in list_.list_cards:
+            new_card = copy_instance(card_, parent_list_id=new_list.list_id)
+            for child in card_.card_checklist_items + card_.card_attachments:
+                copy_instance(child, parent_card_id=new_card.card_id)
+
+
+@app.cli.command('benchmark-copy')
+@click.argument('board_id', type=int)
+@click.option('--repeat', default=5, help='copies made by each path')
+def benchmark_copy(board_id, repeat):
+    """Compare the bulk board copy with the per-instance copy, changes are rolled back."""
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    for name, copy in (('per instance', lambda: copy_board_by_instance(board_id, creator_id=1)),
+                       ('bulk', lambda: copy_board_contents(copy_rows(Board, Board.board_id == board_id,
+                                                                       is_template=False)))):
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        statements.clear()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            copy()
+            db.session.expunge_all()
+        elapsed = time.perf_counter() - start
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+        db.session.rollback()
+        print(f'{name}: {elapsed / repeat * 1000:.1f} ms and {len(statements) // repeat} statements per copy')
+
+
+# --------------------------------------- Rank Keys ----------------------------------------- #
+
+RANK_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def rank_between(before, after):
+    # shortest key sorting between before and after (None is an open end), keys never end with '0'
+    key = ''
+    i = 0
+    while True:
+        low = RANK_DIGITS.index(before[i]) if before and i < len(before) else 0
+        high = RANK_DIGITS.index(after[i]) if after and i < len(after) else len(RANK_DIGITS)
+
+        if low == high:
+            key += RANK_DIGITS[low]
+        elif (low + high) // 2 > low:
+            return key + RANK_DIGITS[(low + high) // 2]
+        else:
+            # no room at this digit, the key is already below after from here on
+            key += RANK_DIGITS[low]
+            after = None
+        i += 1
+
+
+def rank_sequence(count):
+    # count evenly spaced keys, used to rebalance and migrate a whole list of siblings
+    width = 1
+    while len(RANK_DIGITS) ** width <= count:
+        width += 1
+    step = len(RANK_DIGITS) ** width // (count + 1)
+
+    keys = []
+    for i in range(1, count + 1):
+        value = step * i
+        key = ''
+        for _ in range(width):
+            value, digit = divmod(value, len(RANK_DIGITS))
+            key = RANK_DIGITS[digit] + key
+        keys.append(key.rstrip('0'))
+    return keys
+
+
+def rank_at(ranks, position=None):
+    # key that puts a row at the 1-based position among ordered sibling ranks, at the end if no position
+    if position is None or position > len(ranks):
+        position = len(ranks) + 1
+    position = max(position, 1)
+
+    before = ranks[position - 2] if position > 1 else None
+    after = ranks[position - 1] if position <= len(ranks) else None
+    return rank_between(before, after)
+
+
+def lock_board(board_id):
+    # held until the caller commits, so the rank keys of a board are computed one after the other, each from the
+    # siblings committed before it, an empty list included. a no-op write rather than FOR UPDATE, which sqlite
+    # ignores; every flush bumps this row anyway, writers of a board always take it first and can not deadlock
+    db.session.execute(update(Board).where(Board.board_id == board_id)
+                       .values(board_version=Board.board_version).execution_options(synchronize_session=False))
+
+
+def lock_list_board(list_id):
+    lock_board(select(List.parent_board_id).where(List.list_id == list_id).scalar_subquery())
+
+
+def list_rank_at(board_id, position=None, exclude_id=None):
+    lock_board(board_id)
+    siblings = (db.session.query(List.list_id, List.list_rank).filter(List.parent_board_id == board_id)
+                .order_by(List.list_rank, List.list_id).all())
+
+    rank = rank_at([rank for list_id, rank in siblings if list_id != exclude_id], position)
+    if len(rank) > app.config['RANK_MAX_LENGTH']:
+        db.session.info.setdefault('rank_rebalance', set()).add((rebalance_list_ranks, int(board_id)))
+    return rank
+
+
+def card_rank_at(list_id, position=None, exclude_id=None):
+    lock_list_board(list_id)
+    siblings = (db.session.query(Card.card_id, Card.card_rank).filter(Card.parent_list_id == list_id)
+                .order_by(Card.card_rank, Card.card_id).all())
+
+    rank = rank_at([rank for card_id, rank in siblings if card_id != exclude_id], position)
+    if len(rank) > app.config['RANK_MAX_LENGTH']:
+        db.session.info.setdefault('rank_rebalance', set()).add((rebalance_card_ranks, int(list_id)))
+    return rank
+
+
+# --------------------------------------- Rank Rebalancing ----------------------------------------- #
+
+
+def rebalance_list_ranks(board_id):
+    with app.app_context():
+        lock_board(board_id)
+        list_ids = (db.session.query(List.list_id).filter(List.parent_board_id == board_id)
+                    .order_by(List.list_rank, List.list_id).all())
+        if list_ids:
+            db.session.execute(update(List), [{'list_id': list_id, 'list_rank': rank}
+                                              for (list_id,), rank in zip(list_ids, rank_sequence(len(list_ids)))])
+        db.session.commit()
+
+
+def rebalance_card_ranks(list_id):
+    with app.app_context():
+        lock_list_board(list_id)
+        card_ids = (db.session.query(Card.card_id).filter(Card.parent_list_id == list_id)
+                    .order_by(Card.card_rank, Card.card_id).all())
+        if card_ids:
+            db.session.execute(update(Card), [{'card_id': card_id, 'card_rank': rank}
+                                              for (card_id,), rank in zip(card_ids, rank_sequence(len(card_ids)))])
+        db.session.commit()
+
+
+@event.listens_for(Session, 'after_commit')
+def start_rank_rebalance(session):
+    # the moved row has to be committed before its siblings are rewritten
+    for rebalance, parent_id in session.info.pop('rank_rebalance', ()):
+        threading.Thread(target=rebalance, args=(parent_id,), daemon=True).start()
 
 
-# --------------------------------------- Increase Card Position ----------------------------------------- #
+# --------------------------------------- Board Versions ----------------------------------------- #
 
 
-def move_cards_down(from_position, to_position, parent_list_id):
-    for i in range(from_position, to_position):
-        i *= -1
-        card_to_edit = Card.query.filter_by(card_position=i, parent_list_id=parent_list_id).first()
-        card_to_edit.card_position = i + 1
+def touch_boards(session, board_ids):
+    board_ids = {int(board_id) for board_id in board_ids if board_id is not None}
+    if board_ids:
+        session.execute(update(Board).where(Board.board_id.in_(board_ids))
+                        .values(board_version=Board.board_version + 1)
+                        .execution_options(synchronize_session=False))
+
+
+def parent_ids(instance, parent_key):
+    # current parent and, when it was moved, the previous one
+    history = inspect(instance).attrs[parent_key].history
+    return {getattr(instance, parent_key), *history.deleted}
+
+
+@event.listens_for(Session, 'before_flush')
+def bump_board_versions(session, flush_context, instances):
+    board_ids, list_ids, card_ids = set(), set(), set()
+
+    for instance in [*session.new, *session.dirty, *session.deleted]:
+        if instance in session.dirty and not session.is_modified(instance):
+            continue
+        if isinstance(instance, Board) and instance not in session.new:
+            board_ids.add(instance.board_id)
+        elif isinstance(instance, List):
+            board_ids |= parent_ids(instance, 'parent_board_id')
+        elif isinstance(instance, Card):
+            list_ids |= parent_ids(instance, 'parent_list_id')
+        elif isinstance(instance, (ChecklistItem, Attachment)):
+            card_ids |= parent_ids(instance, 'parent_card_id')
+
+    card_ids.discard(None)
+    list_ids.discard(None)
+    with session.no_autoflush:
+        if card_ids:
+            list_ids |= {list_id for (list_id,) in
+                         session.query(Card.parent_list_id).filter(Card.card_id.in_(card_ids))}
+        if list_ids:
+            board_ids |= {board_id for (board_id,) in
+                          session.query(List.parent_board_id).filter(List.list_id.in_(list_ids))}
+        touch_boards(session, board_ids)
+
+
+# --------------------------------------- Board Change Feed ----------------------------------------- #
+
+
+class LocalBroker:
+    # fans events out to the subscribers of this process, enough for a single worker and for tests
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, board_id):
+        subscription = queue.Queue(maxsize=100)
+        with self.lock:
+            self.subscribers.setdefault(board_id, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, board_id, subscription):
+        with self.lock:
+            self.subscribers.get(board_id, []).remove(subscription)
+            if not self.subscribers.get(board_id):
+                self.subscribers.pop(board_id, None)
+
+    def send(self, session, events):
+        # called before the commit, local subscribers only hear of it once it is done
+        pass
+
+    def publish(self, events):
+        for board_id, event_ in events:
+            self.deliver(board_id, event_)
+
+    def deliver(self, board_id, event_):
+        with self.lock:
+            subscriptions = list(self.subscribers.get(board_id, []))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event_)
+            except queue.Full:
+                # a stalled client, it resyncs from the api with its etag
+                pass
+
+
+class PostgresBroker(LocalBroker):
+    # events go through NOTIFY, every worker LISTENs and fans them out to its own subscribers
+
+    channel = 'board_events'
+
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    def subscribe(self, board_id):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, daemon=True)
+                self.listener.start()
+        return super().subscribe(board_id)
+
+    # NOTIFY refuses payloads of 8000 bytes and more
+    max_payload = 7500
+
+    def send(self, session, events):
+        # one statement in the committing transaction, postgres delivers it on commit and drops it on rollback
+        payloads, batch = [], []
+        for board_id, event_ in events:
+            message = json.dumps([board_id, event_], default=str)
+            if len(message.encode()) > self.max_payload:
+                # long descriptions and the like, listeners reload the board from the api anyway
+                message = json.dumps([board_id, {key: event_[key] for key in ('type', 'id')}])
+            if batch and len(', '.join([*batch, message]).encode()) + 2 > self.max_payload:
+                payloads.append(f'[{", ".join(batch)}]')
+                batch = []
+            batch.append(message)
+        payloads.append(f'[{", ".join(batch)}]')
+
+        session.execute(text('SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS TEXT[])) AS payload'),
+                        {'channel': self.channel, 'payloads': payloads})
+
+    def publish(self, events):
+        # delivered by the listener of every worker, this one included
+        pass
+
+    def listen(self):
+        while True:
+            try:
+                connection = db.engine.raw_connection()
+                # kept out of the pool, it stays in LISTEN for the life of the worker
+                connection.detach()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute(f'LISTEN {self.channel}')
+
+                while True:
+                    if select_module.select([dbapi_connection], [], [], 30) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        for board_id, event_ in json.loads(dbapi_connection.notifies.pop(0).payload):
+                            self.deliver(board_id, event_)
+            except Exception as error:
+                app.logger.error(f'board change feed listener restarting: {error}')
+                time.sleep(5)
+
+
+def board_event_broker_for(name):
+    if name == 'postgres':
+        return PostgresBroker()
+    return LocalBroker()
+
+
+board_event_broker = board_event_broker_for(app.config['BOARD_EVENTS_BROKER'])
+
+event_kinds = {Board: 'board', List: 'list', Card: 'card', ChecklistItem: 'item', Attachment: 'attachment'}
+
+
+def instances_board_ids(session, instances):
+    # boards each instance belongs to, before and after a move, with at most two lookups for the whole flush
+    list_ids = {instance: parent_ids(instance, 'parent_list_id') - {None}
+                for instance in instances if isinstance(instance, Card)}
+    card_ids = {instance: parent_ids(instance, 'parent_card_id') - {None}
+                for instance in instances if isinstance(instance, (ChecklistItem, Attachment))}
+
+    wanted_card_ids = set().union(*card_ids.values())
+    card_lists = dict(session.execute(select(Card.card_id, Card.parent_list_id)
+                                      .where(Card.card_id.in_(wanted_card_ids))).all()) if wanted_card_ids else {}
+    for instance, ids in card_ids.items():
+        list_ids[instance] = {card_lists[card_id] for card_id in ids if card_id in card_lists}
+
+    wanted_list_ids = set().union(*list_ids.values())
+    list_boards = dict(session.execute(select(List.list_id, List.parent_board_id)
+                                       .where(List.list_id.in_(wanted_list_ids))).all()) if wanted_list_ids else {}
+
+    board_ids = {}
+    for instance in instances:
+        if isinstance(instance, Board):
+            board_ids[instance] = {instance.board_id}
+        elif isinstance(instance, List):
+            board_ids[instance] = parent_ids(instance, 'parent_board_id') - {None}
+        else:
+            board_ids[instance] = {list_boards[list_id] for list_id in list_ids[instance] if list_id in list_boards}
+    return board_ids
+
+
+def queue_board_event(session, board_id, event_):
+    # sent with the commit
+    session.info.setdefault('board_events', []).append((int(board_id), event_))
+
+
+def collect_board_events(session, flush_context):
+    collected = []
+    for instance in [*session.new, *session.dirty, *session.deleted]:
+        kind = event_kinds.get(type(instance))
+        if kind is None or (instance in session.dirty and not session.is_modified(instance)):
+            continue
+
+        state = inspect(instance)
+        event_ = {'type': kind, 'id': state.mapper.primary_key_from_instance(instance)[0]}
+        if instance in session.new:
+            event_['type'] += '.created'
+        elif instance in session.deleted:
+            event_['type'] += '.deleted'
+        else:
+            changes = {attribute.key: attribute.value for attribute in state.attrs
+                       if attribute.key in state.mapper.columns.keys() and attribute.history.has_changes()}
+            if {'list_rank', 'card_rank', 'parent_board_id', 'parent_list_id'} & changes.keys():
+                event_['type'] += '.moved'
+            elif changes.keys() == {'item_status'}:
+                event_['type'] += '.toggled'
+            else:
+                event_['type'] += '.updated'
+            event_['changes'] = {key: value for key, value in changes.items() if not key.endswith('_rank')}
+        collected.append((instance, event_))
+
+    if not collected:
+        return
+    with session.no_autoflush:
+        board_ids = instances_board_ids(session, [instance for instance, _ in collected])
+    for instance, event_ in collected:
+        for board_id in board_ids[instance]:
+            queue_board_event(session, board_id, event_)
+
+
+def send_board_events(session):
+    # the last flush runs after before_commit, done here so its events go out with the others
+    session.flush()
+    if session.info.get('board_events'):
+        board_event_broker.send(session, session.info['board_events'])
+
+
+def publish_board_events(session):
+    events = session.info.pop('board_events', ())
+    if not events:
+        return
+    try:
+        board_event_broker.publish(events)
+    except Exception as error:
+        app.logger.error(f'board change not published: {error}')
+
+
+def drop_board_events(session):
+    session.info.pop('board_events', None)
+
+
+# nothing listens while the stream is off, board pages poll the etag and no flush pays for the events
+if app.config['BOARD_EVENTS_STREAM']:
+    event.listen(Session, 'after_flush', collect_board_events)
+    event.listen(Session, 'before_commit', send_board_events)
+    event.listen(Session, 'after_commit', publish_board_events)
+    event.listen(Session, 'after_rollback', drop_board_events)
+
+
+# --------------------------------------- Schema Migrations ----------------------------------------- #
+
+
+def migrate_position_ranks():
+    # replace the integer list_position / card_position columns with rank keys
+    inspector = inspect(db.engine)
+    sqlite = db.engine.dialect.name == 'sqlite'
+
+    for table, id_column, parent_column, position_column, rank_column in (
+            ('lists', 'list_id', 'parent_board_id', 'list_position', 'list_rank'),
+            ('cards', 'card_id', 'parent_list_id', 'card_position', 'card_rank')):
+        columns = [column['name'] for column in inspector.get_columns(table)]
+        if position_column not in columns:
+            continue
+
+        if rank_column not in columns:
+            # sqlite can not add NOT NULL to an existing column, it only accepts it with a default
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {rank_column} VARCHAR(64)' +
+                                    (" NOT NULL DEFAULT ''" if sqlite else '')))
+
+        siblings = {}
+        for row_id, parent_id in db.session.execute(text(
+                f'SELECT {id_column}, {parent_column} FROM {table} ORDER BY {parent_column}, {position_column}, '
+                f'{id_column}')):
+            siblings.setdefault(parent_id, []).append(row_id)
+
+        for row_ids in siblings.values():
+            db.session.execute(text(f'UPDATE {table} SET {rank_column} = :rank WHERE {id_column} = :row_id'),
+                               [{'rank': rank, 'row_id': row_id}
+                                for row_id, rank in zip(row_ids, rank_sequence(len(row_ids)))])
+
+        if not sqlite:
+            db.session.execute(text(f'ALTER TABLE {table} ALTER COLUMN {rank_column} SET NOT NULL'))
+        db.session.execute(text(f'ALTER TABLE {table} DROP COLUMN {position_column}'))
+        db.session.commit()
+        print(f'{table}: {sum(len(row_ids) for row_ids in siblings.values())} rows ranked')
+
+
+def migrate_rank_not_null():
+    # databases ranked before migrate_position_ranks set NOT NULL, sqlite ones keep the nullable column
+    if db.engine.dialect.name == 'sqlite':
+        return
+
+    inspector = inspect(db.engine)
+    for table, rank_column in (('lists', 'list_rank'), ('cards', 'card_rank')):
+        for column in inspector.get_columns(table):
+            if column['name'] == rank_column and column['nullable']:
+                db.session.execute(text(f'ALTER TABLE {table} ALTER COLUMN {rank_column} SET NOT NULL'))
+    db.session.commit()
+
+
+def migrate_indexes():
+    # indexes declared on the models, built without blocking writes on postgres
+    inspector = inspect(db.engine)
+    postgres = db.engine.dialect.name == 'postgresql'
+
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for index in table.indexes:
+                # an index on a column of a later migration is built by that migration
+                if index.name in existing or not {column.name for column in index.columns} <= columns:
+                    continue
+                statement = str(CreateIndex(index).compile(dialect=db.engine.dialect))
+                if postgres:
+                    statement = statement.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+                connection.execute(text(statement))
+                print(f'{table.name}: {index.name} created')
+
+
+def migrate_board_version():
+    if 'board_version' not in [column['name'] for column in inspect(db.engine).get_columns('boards')]:
+        db.session.execute(text('ALTER TABLE boards ADD COLUMN board_version INTEGER NOT NULL DEFAULT 0'))
         db.session.commit()
 
 
-# --------------------------------------- Decrease Card Position ----------------------------------------- #
+def migrate_attachment_key():
+    if 'attachment_key' not in [column['name'] for column in inspect(db.engine).get_columns('attachments')]:
+        db.session.execute(text('ALTER TABLE attachments ADD COLUMN attachment_key VARCHAR(100)'))
+        db.session.commit()
+    migrate_indexes()
+
+
+def touch_card_boards(card_ids):
+    # the cached list columns are keyed by board_version, links rewritten under them need a new version
+    card_ids = list(card_ids)
+    board_ids = set()
+    for start in range(0, len(card_ids), 500):
+        board_ids.update(db.session.scalars(select(List.parent_board_id)
+                                            .join(Card, Card.parent_list_id == List.list_id)
+                                            .where(Card.card_id.in_(card_ids[start:start + 500]))))
+    touch_boards(db.session, board_ids)
+
+
+def migrate_attachment_urls():
+    # content addressed files leave static/, their links go through the attachment_file route
+    old_root = 'static/all_uploads/objects/'
+    if os.path.isdir(old_root):
+        for folder in os.listdir(old_root):
+            os.makedirs(os.path.join(app.config['ATTACHMENT_ROOT'], folder), exist_ok=True)
+            for name in os.listdir(os.path.join(old_root, folder)):
+                shutil.move(os.path.join(old_root, folder, name),
+                            os.path.join(app.config['ATTACHMENT_ROOT'], folder, name))
+
+    card_ids = set()
+    for attachment in Attachment.query.filter(Attachment.attachment_key.is_not(None)):
+        new_path = f'/attachments/{attachment.attachment_key}'
+        Card.query.filter_by(card_cover=attachment.attachment_path).update({'card_cover': new_path})
+        attachment.attachment_path = new_path
+        card_ids.add(attachment.parent_card_id)
+    touch_card_boards(card_ids)
+    db.session.commit()
+    migrate_legacy_attachments()
+
+
+def migrate_legacy_attachments():
+    # files saved under static/ before content addressing are stored by their hash too, nothing stays public
+    keys = {}
+    card_ids = set()
+    for attachment in Attachment.query.filter(Attachment.attachment_key.is_(None)):
+        old_path = attachment.attachment_path
+        if old_path not in keys:
+            keys[old_path] = None
+            if os.path.isfile(old_path.lstrip('/')):
+                staged_path = staging_path(f'{secrets.token_hex(16)}.part')
+                shutil.copyfile(old_path.lstrip('/'), staged_path)
+                keys[old_path] = store_staged(staged_path, file_digest(staged_path),
+                                              attachment.attachment_extension.lower())
+            else:
+                print(f'{old_path}: file missing, attachment left as is')
+        if keys[old_path] is None:
+            continue
+
+        new_path = f'/attachments/{keys[old_path]}'
+        Card.query.filter_by(card_cover=old_path).update({'card_cover': new_path})
+        attachment.attachment_key = keys[old_path]
+        attachment.attachment_path = new_path
+        card_ids.add(attachment.parent_card_id)
+    touch_card_boards(card_ids)
+    db.session.commit()
+
+    # removed once no row points at them any more
+    for old_path, key in keys.items():
+        if key is not None:
+            os.remove(old_path.lstrip('/'))
+    print(f'{sum(key is not None for key in keys.values())} legacy files stored by content')
+
+
+def migrate_cascading_foreign_keys():
+    # sqlite can not alter a constraint, there the teardown functions delete the children themselves
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        for foreign_key in table.foreign_key_constraints:
+            if foreign_key.ondelete != 'CASCADE':
+                continue
+            for existing in inspector.get_foreign_keys(table.name):
+                if (existing['constrained_columns'] == list(foreign_key.column_keys) and
+                        existing['options'].get('ondelete') != 'CASCADE'):
+                    db.session.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT {existing["name"]}'))
+                    db.session.execute(AddConstraint(foreign_key))
+    db.session.commit()
+
+
+# applied in order by 'flask upgrade-db', append new migrations at the end and never reorder them
+schema_migrations = [
+    (1, 'position ranks', migrate_position_ranks),
+    (2, 'foreign key and ordering indexes', migrate_indexes),
+    (3, 'board version', migrate_board_version),
+    (4, 'attachment key', migrate_attachment_key),
+    (5, 'attachment download urls', migrate_attachment_urls),
+    (6, 'cascading foreign keys', migrate_cascading_foreign_keys),
+    (7, 'rank columns not null', migrate_rank_not_null),
+    (8, 'legacy attachment files', migrate_legacy_attachments),
+]
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """Apply the schema migrations the database has not seen yet."""
+    applied = {version for (version,) in db.session.query(SchemaVersion.version)}
+    db.session.rollback()
+
+    for version, version_name, migrate in schema_migrations:
+        if version in applied:
+            continue
+        print(f'applying {version}: {version_name}')
+        migrate()
+        db.session.add(SchemaVersion(version=version, version_name=version_name, applied_date=datetime.now()))
+        db.session.commit()
+
+
+# --------------------------------------- Query Plan Check ----------------------------------------- #
+
+
+def hot_queries():
+    return [
+        ('board lists', select(List).where(List.parent_board_id == 1).order_by(List.list_rank, List.list_id)),
+        ('list cards', select(Card).where(Card.parent_list_id.in_([1, 2])).order_by(Card.card_rank, Card.card_id)),
+        ('card checklist items', select(ChecklistItem).where(ChecklistItem.parent_card_id.in_([1, 2]))),
+        ('card attachments', select(Attachment).where(Attachment.parent_card_id.in_([1, 2]))),
+        ('card cover', select(Attachment).where(Attachment.parent_card_id == 1, Attachment.is_cover_image.is_(True))),
+        ('recent boards', select(Board).where(Board.creator_id == 1, Board.is_template.is_(False))
+         .order_by(desc(Board.board_recent_open_time))),
+        ('added boards', select(Board).where(Board.creator_id == 1, Board.is_template.is_(False))
+         .order_by(desc(Board.board_added_date))),
+        ('templates', select(Board).where(Board.is_template.is_(True))),
+        ('workspace boards', select(Board).where(Board.parent_workspace_id == 1, Board.is_template.is_(False))),
+        ('user workspaces', select(Workspace).where(Workspace.creator_id == 1).order_by(Workspace.workspace_id)),
+    ]
+
+
+def query_plan(statement):
+    sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        return [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+    return [row[0] for row in db.session.execute(text(f'EXPLAIN {sql}'))]
+
+
+def is_table_scan(line):
+    if db.engine.dialect.name == 'sqlite':
+        return line.startswith('SCAN') and 'INDEX' not in line
+    return 'Seq Scan' in line
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if a hot query is planned as a full table scan."""
+    if db.engine.dialect.name == 'postgresql':
+        # small tables are cheaper to scan, only fall back to it when no index can be used
+        db.session.execute(text('SET enable_seqscan = off'))
+
+    failed = []
+    for name, statement in hot_queries():
+        plan = query_plan(statement)
+        scans = [line.strip() for line in plan if is_table_scan(line.strip())]
+        print(f'{name}: {"table scan" if scans else "ok"}')
+        if scans:
+            failed.append(f'{name}: {"; ".join(scans)}')
+    db.session.rollback()
+
+    if failed:
+        raise click.ClickException('hot queries without an index:\n' + '\n'.join(failed))
+
+
+# --------------------------------------- Board Loader ----------------------------------------- #
+
+
+def load_board_lists(board_id):
+    # lists of one board with their cards (2 queries, whatever the size of the database), both come in (rank, id)
+    # order so their positions are counted here
+    lists = (List.query.filter_by(parent_board_id=board_id)
+             .options(selectinload(List.list_cards))
+             .order_by(List.list_rank, List.list_id).all())
+    for list_position, list_ in enumerate(lists, 1):
+        set_committed_value(list_, 'list_position', list_position)
+        for card_position, card_ in enumerate(list_.list_cards, 1):
+            set_committed_value(card_, 'card_position', card_position)
+    return lists
+
+
+def load_card_badges(board_id):
+    # attachment count and checklist done/total of every card in a board, one grouped query each
+    badges = {}
 
+    attachment_counts = (db.session.query(Attachment.parent_card_id, func.count(Attachment.attachment_id))
+                         .join(Card, Card.card_id == Attachment.parent_card_id)
+                         .join(List, List.list_id == Card.parent_list_id)
+                         .filter(List.parent_board_id == board_id)
+                         .group_by(Attachment.parent_card_id).all())
 
-def move_cards_up(from_position, to_position, parent_list_id):
-    for i in range(from_position, to_position):
-        card_to_edit = Card.query.filter_by(card_position=i, parent_list_id=parent_list_id).first()
+    item_counts = (db.session.query(ChecklistItem.parent_card_id,
+                                    func.sum(case((ChecklistItem.item_status.is_(True), 1), else_=0)),
+                                    func.count(ChecklistItem.item_id))
+                   .join(Card, Card.card_id == ChecklistItem.parent_card_id)
+                   .join(List, List.list_id == Card.parent_list_id)
+                   .filter(List.parent_board_id == board_id)
+                   .group_by(ChecklistItem.parent_card_id).all())
+
+    for card_id, attachments in attachment_counts:
+        badges[card_id] = {'attachments': attachments, 'items_done': 0, 'items_total': 0}
+
+    for card_id, items_done, items_total in item_counts:
+        badge = badges.setdefault(card_id, {'attachments': 0, 'items_done': 0, 'items_total': 0})
+        badge['items_done'] = int(items_done or 0)
+        badge['items_total'] = items_total
+
+    return badges
 
-        card_to_edit.card_position = i - 1
+
+def load_list_positions(user_id, board_id):
+    # (board id, list position) pairs for the move list dialog of the user's boards and the opened one
+    return (db.session.query(List.parent_board_id,
+                             func.row_number().over(partition_by=List.parent_board_id,
+                                                    order_by=(List.list_rank, List.list_id)).label('list_position'))
+            .join(Board, Board.board_id == List.parent_board_id)
+            .filter(or_(and_(Board.creator_id == user_id, Board.is_template.is_(False)), Board.board_id == board_id))
+            .order_by(List.parent_board_id, List.list_rank, List.list_id).all())
+
+
+# --------------------------------------- Card Loader ----------------------------------------- #
+
+
+def load_card(card_id):
+    # one card with its list, checklist items and attachments (3 queries, whatever the size of the board)
+    one_card = (Card.query.options(undefer(Card.card_position), joinedload(Card.parent_list).undefer(List.list_position),
+                                   selectinload(Card.card_checklist_items), selectinload(Card.card_attachments))
+                .filter_by(card_id=card_id).first())
+    if one_card is None:
+        abort(404)
+    return one_card
+
+
+def load_card_targets(board_id):
+    # lists and card counts of the boards a card of this board can be moved or copied to, in one grouped query
+    # [{'id', 'name', 'lists': [{'id', 'position', 'cards'}]}], the board itself first and the others by id
+    workspace_id = select(Board.parent_workspace_id).where(Board.board_id == board_id).scalar_subquery()
+    rows = (db.session.query(Board.board_id, Board.board_name, List.list_id, func.count(Card.card_id))
+            .outerjoin(List, List.parent_board_id == Board.board_id)
+            .outerjoin(Card, Card.parent_list_id == List.list_id)
+            .filter(or_(Board.board_id == board_id,
+                        and_(Board.parent_workspace_id == workspace_id, Board.is_template.is_(False))))
+            .group_by(Board.board_id, Board.board_name, List.list_id, List.list_rank)
+            .order_by(Board.board_id != board_id, Board.board_id, List.list_rank, List.list_id).all())
+
+    boards = {}
+    for board_id_, board_name, list_id, card_count in rows:
+        board_ = boards.setdefault(board_id_, {'id': board_id_, 'name': board_name, 'lists': []})
+        if list_id is not None:
+            # the (rank, id) order is what list_position counts, without its subquery per row
+            board_['lists'].append({'id': list_id, 'position': len(board_['lists']) + 1, 'cards': card_count})
+    return list(boards.values())
+
+
+# --------------------------------------- Dashboard Loader ----------------------------------------- #
+
+
+def load_dashboard(user_id):
+    # everything boards_manager shows in two queries, the orderings and the grouping are made in memory
+    # returns (workspaces, boards by last open, {workspace id: boards by date added}, templates)
+    workspaces = Workspace.query.filter_by(creator_id=user_id).order_by(Workspace.workspace_id).all()
+    boards = (Board.query.options(joinedload(Board.parent_workspace))
+              .filter(or_(and_(Board.creator_id == user_id, Board.is_template.is_(False)), Board.is_template.is_(True)))
+              .order_by(Board.board_id).all())
+
+    own_boards = [board_ for board_ in boards if not board_.is_template]
+    # opens of this worker not flushed yet count too
+    boards_recent = sorted(own_boards, key=lambda board_: board_open_time(board_) or datetime.min, reverse=True)
+
+    boards_by_workspace = {}
+    for board_ in sorted(own_boards, key=lambda board_: board_.board_added_date, reverse=True):
+        boards_by_workspace.setdefault(board_.parent_workspace_id, []).append(board_)
+
+    return workspaces, boards_recent, boards_by_workspace, [board_ for board_ in boards if board_.is_template]
+
+
+# --------------------------------------- Render Cache ----------------------------------------- #
+
+
+class RenderCache:
+    # least recently used fragments are evicted once the cached html passes max_bytes
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.fragments = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment):
+        with self.lock:
+            if key in self.fragments:
+                self.size -= len(self.fragments.pop(key))
+            self.fragments[key] = fragment
+            self.size += len(fragment)
+            while self.size > self.max_bytes and self.fragments:
+                self.size -= len(self.fragments.popitem(last=False)[1])
+
+
+class SharedRenderCache(RenderCache):
+    # the local lru in front of a redis compatible server shared by every worker
+
+    def __init__(self, max_bytes, url, ttl):
+        super().__init__(max_bytes)
+        self.server = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        fragment = super().get(key)
+        if fragment is None:
+            try:
+                shared = self.server.get(key)
+            except redis.RedisError:
+                return None
+            if shared is not None:
+                fragment = shared.decode()
+                super().set(key, fragment)
+        return fragment
+
+    def set(self, key, fragment):
+        super().set(key, fragment)
+        try:
+            # old board versions are never asked for again, the ttl clears them
+            self.server.set(key, fragment, ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+
+def render_cache_for(url):
+    if url and redis is None:
+        app.logger.warning('RENDER_CACHE_URL is set but redis is not installed, using the local render cache')
+    if url and redis is not None:
+        return SharedRenderCache(app.config['RENDER_CACHE_MAX_BYTES'], url, app.config['RENDER_CACHE_TTL'])
+    return RenderCache(app.config['RENDER_CACHE_MAX_BYTES'])
+
+
+render_cache = render_cache_for(app.config['RENDER_CACHE_URL'])
+
+
+def board_lists_chunks(one_board, all_boards):
+    # the list columns only change with the board version, who is admin and the names of the user's boards
+    # iterated by board.html, on a miss the first lists reach the browser while the others render
+    boards_fingerprint = hashlib.sha1(repr([(board_.board_id, board_.board_name)
+                                            for board_ in all_boards]).encode()).hexdigest()
+    key = (f'board-lists:{one_board.board_id}:{one_board.board_version}:{int(current_user.id == 1)}:'
+           f'{boards_fingerprint}')
+
+    fragment = render_cache.get(key)
+    if fragment is not None:
+        yield Markup(fragment)
+        return
+
+    context = {'board_lists': load_board_lists(one_board.board_id),
+               'card_badges': load_card_badges(one_board.board_id), 'one_board': one_board,
+               'all_boards': all_boards, 'user': current_user}
+    app.update_template_context(context)
+
+    chunks = []
+    for chunk in app.jinja_env.get_template('board_lists.html').generate(context):
+        chunks.append(chunk)
+        yield Markup(chunk)
+    render_cache.set(key, ''.join(chunks))
+
+
+# --------------------------------------- Page Rendering ----------------------------------------- #
+
+
+def render_page(template_name, **context):
+    # streamed in STREAM_BUFFER_SIZE pieces, the header and navigation are sent before the body is rendered
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+
+    def buffered(chunks):
+        buffer, size = [], 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= app.config['STREAM_BUFFER_SIZE']:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+
+    return app.response_class(buffered(stream_template(template_name, **context)), mimetype='text/html')
+
+
+# --------------------------------------- Recently Opened Boards ----------------------------------------- #
+
+board_opens = {}
+board_opens_lock = threading.Lock()
+board_opens_flusher = []
+
+
+def track_board_open(board_id):
+    # remembered in memory, repeated opens of a board between two flushes make one UPDATE
+    start_board_opens_flusher()
+    with board_opens_lock:
+        board_opens[board_id] = datetime.now()
+
+
+def start_board_opens_flusher():
+    with board_opens_lock:
+        if not board_opens_flusher:
+            flusher = threading.Thread(target=flush_board_opens_forever, daemon=True)
+            flusher.start()
+            board_opens_flusher.append(flusher)
+
+
+def flush_board_opens_forever():
+    while True:
+        time.sleep(app.config['RECENT_OPEN_FLUSH_INTERVAL'])
+        try:
+            flush_board_opens()
+        except Exception as error:
+            app.logger.error(f'recently opened boards not saved: {error}')
+
+
+def flush_board_opens():
+    with board_opens_lock:
+        opens = dict(board_opens)
+    if not opens:
+        return
+
+    with app.app_context():
+        board_ids = {board_id for (board_id,) in
+                     db.session.query(Board.board_id).filter(Board.board_id.in_(opens))}
+        if board_ids:
+            db.session.execute(update(Board), [{'board_id': board_id, 'board_recent_open_time': opens[board_id]}
+                                               for board_id in board_ids])
         db.session.commit()
 
+    # kept until written so the boards manager never sees an open go back in time
+    with board_opens_lock:
+        for board_id, opened in opens.items():
+            if board_opens.get(board_id) == opened:
+                del board_opens[board_id]
+
+
+def board_open_time(one_board):
+    with board_opens_lock:
+        return board_opens.get(one_board.board_id, one_board.board_recent_open_time)
+
+
+atexit.register(flush_board_opens)
+
+
+# --------------------------------------- Attachment Storage ----------------------------------------- #
+
+
+class LocalStorage:
+    # objects under root, fanned out by the first two characters of the key, served by attachment_file
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def refresh(self, key):
+        # marks the object as just used, false when there is none
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def modified(self, key):
+        try:
+            return os.path.getmtime(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def put(self, key, staged_path):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        shutil.move(staged_path, self.path(key))
+
+    def delete_many(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def keys(self):
+        # (key, modified timestamp) of every stored object
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                yield name, os.path.getmtime(os.path.join(folder, name))
+
+    def send(self, key, download_name, as_attachment):
+        if app.config['ATTACHMENT_ACCEL_REDIRECT']:
+            # nginx reads the file and answers range requests itself
+            response = app.response_class(
+                mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = (app.config['ATTACHMENT_ACCEL_REDIRECT'].rstrip('/') +
+                                                    f'/{key[:2]}/{key}')
+            response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                                 filename=secure_download_name(download_name))
+            response.set_etag(key)
+            return response.make_conditional(request)
+
+        # X-Sendfile with USE_X_SENDFILE, otherwise a wsgi.file_wrapper that gunicorn sends with sendfile()
+        return send_file(os.path.abspath(self.path(key)), download_name=download_name, as_attachment=as_attachment,
+                         etag=key, conditional=True)
+
+
+class S3Storage:
+    # any S3 compatible store, the endpoint points it at minio or a moto server
+    def __init__(self, bucket, endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("ATTACHMENT_STORAGE 's3' needs boto3 installed")
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def refresh(self, key):
+        # copied onto itself, which moves its LastModified
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': key},
+                                    MetadataDirective='REPLACE')
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def modified(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['LastModified'].timestamp()
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def put(self, key, staged_path):
+        # multipart above the transfer threshold, read from disk piece by piece
+        self.client.upload_file(staged_path, self.bucket, key)
+        os.remove(staged_path)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+
+    def keys(self):
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket):
+            for stored in page.get('Contents', ()):
+                yield stored['Key'], stored['LastModified'].timestamp()
+
+    def send(self, key, download_name, as_attachment):
+        # the store itself answers the download, ranges and conditional requests included
+        disposition = 'attachment' if as_attachment else 'inline'
+        return redirect(self.client.generate_presigned_url(
+            'get_object', ExpiresIn=app.config['ATTACHMENT_LINK_TTL'],
+            Params={'Bucket': self.bucket, 'Key': key,
+                    'ResponseContentDisposition': f'{disposition}; filename="{secure_download_name(download_name)}"'}))
+
+
+def attachment_storage_for(name):
+    if name == 's3':
+        return S3Storage(app.config['ATTACHMENT_BUCKET'], app.config['ATTACHMENT_S3_ENDPOINT'])
+    return LocalStorage(app.config['ATTACHMENT_ROOT'])
+
+
+attachment_storage = attachment_storage_for(app.config['ATTACHMENT_STORAGE'])
+
+
+def attachment_url(key):
+    return url_for('attachment_file', key=key)
+
+
+def secure_download_name(name):
+    # for headers built by hand, send_file encodes the name itself
+    return name.encode('ascii', 'ignore').decode().replace('"', '').replace('\\', '') or 'attachment'
+
+
+def staging_path(name):
+    os.makedirs(app.config['ATTACHMENT_STAGING'], exist_ok=True)
+    return os.path.join(app.config['ATTACHMENT_STAGING'], name)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as staged:
+        while chunk := staged.read(app.config['ATTACHMENT_CHUNK_SIZE']):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_upload(stream, extension):
+    # copied to a staging file in chunks while hashed, the whole file is never held in memory
+    staged_path = staging_path(f'{secrets.token_hex(16)}.part')
+    digest = hashlib.sha256()
+    with open(staged_path, 'wb') as staged:
+        while chunk := stream.read(app.config['ATTACHMENT_CHUNK_SIZE']):
+            digest.update(chunk)
+            staged.write(chunk)
+    return store_staged(staged_path, digest.hexdigest(), extension)
+
+
+def store_staged(staged_path, digest, extension):
+    # the same content uploaded twice is stored once, a reused object is refreshed so the reaper and sweep-uploads
+    # leave it alone until its attachment is committed
+    key = digest + extension
+    if attachment_storage.refresh(key):
+        os.remove(staged_path)
+    else:
+        attachment_storage.put(key, staged_path)
+    return key
+
+
+def save_attachment(card_, name, extension, key, is_cover):
+    new_attachment = Attachment(attachment_name=name, attachment_extension=extension,
+                                attachment_upload_date=datetime.now(), attachment_path=attachment_url(key),
+                                attachment_key=key, is_cover_image=is_cover, parent_card_id=card_.card_id,
+                                creator_id=current_user.id)
+    db.session.add(new_attachment)
+    db.session.flush()
+    queue_image_variants(key)
+
+    if is_cover:
+        # added first so a replaced cover with the same content keeps its stored object
+        for old_cover in Attachment.query.filter(Attachment.parent_card_id == card_.card_id,
+                                                 Attachment.is_cover_image.is_(True),
+                                                 Attachment.attachment_id != new_attachment.attachment_id):
+            release_attachment(old_cover)
+        card_.card_cover = new_attachment.attachment_path
+    return new_attachment
+
+
+def release_attachment(attachment):
+    db.session.delete(attachment)
+    release_files(db.session, [(attachment.attachment_key, attachment.attachment_path)])
+
+
+# --------------------------------------- Image Variants ----------------------------------------- #
+
+image_variant_queue = queue.Queue()
+image_variants_pending = set()
+image_workers = []
+image_workers_lock = threading.Lock()
+
+
+def image_variant_key(key, width):
+    return f'{key}.w{width}.webp'
+
+
+def original_key(key):
+    return re.sub(r'\.w\d+\.webp$', '', key)
+
+
+def has_image_variants(key):
+    return Image is not None and os.path.splitext(key)[1] in app.config['IMAGE_VARIANT_EXTENSIONS']
+
+
+def queue_image_variants(key):
+    # every key is queued once per process, a request for a missing variant queues it again later
+    if not has_image_variants(key):
+        return
+    with image_workers_lock:
+        if key in image_variants_pending:
+            return
+        image_variants_pending.add(key)
+    start_image_workers()
+    image_variant_queue.put(key)
+
+
+def start_image_workers():
+    with image_workers_lock:
+        if not image_workers:
+            for _ in range(app.config['IMAGE_WORKERS']):
+                worker = threading.Thread(target=make_image_variants_forever, daemon=True)
+                worker.start()
+                image_workers.append(worker)
+
+
+def make_image_variants_forever():
+    while True:
+        key = image_variant_queue.get()
+        try:
+            make_image_variants(key)
+        except Exception as error:
+            app.logger.error(f'image variants of {key} not made: {error}')
+        finally:
+            with image_workers_lock:
+                image_variants_pending.discard(key)
+
+
+def make_image_variants(key):
+    with attachment_storage.open(key) as original:
+        image = Image.open(io.BytesIO(original.read()))
+        image.load()
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    for width in app.config['IMAGE_VARIANT_WIDTHS']:
+        variant_key = image_variant_key(key, width)
+        if attachment_storage.exists(variant_key):
+            continue
+        variant = image.copy()
+        # never enlarged, a small image gets a copy of its own size
+        variant.thumbnail((width, width * 10))
+        staged_path = staging_path(f'{secrets.token_hex(16)}.webp')
+        variant.save(staged_path, 'WEBP', quality=app.config['IMAGE_VARIANT_QUALITY'])
+        attachment_storage.put(variant_key, staged_path)
+
+
+@app.template_filter('resized')
+def resized_image(url, width):
+    # about this wide, unsplash resizes on its cdn, uploaded images come from their variants
+    if url and url.startswith('https://images.unsplash.com/'):
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        query.update(w=str(width), auto='format')
+        return urlunsplit(parts._replace(query=urlencode(query)))
+    if url and url.startswith('/attachments/') and has_image_variants(url):
+        variant_width = min([variant_width for variant_width in app.config['IMAGE_VARIANT_WIDTHS']
+                             if variant_width >= width] or [max(app.config['IMAGE_VARIANT_WIDTHS'])])
+        return f'{url}?w={variant_width}'
+    return url
+
+
+@app.template_filter('srcset')
+def image_srcset(url, *widths):
+    # empty for images that only come in one size, the browser then keeps src
+    if url and url.startswith('/attachments/') and has_image_variants(url):
+        widths = app.config['IMAGE_VARIANT_WIDTHS']
+    elif not (url and url.startswith('https://images.unsplash.com/')):
+        return ''
+    return ', '.join(f'{resized_image(url, width)} {width}w' for width in widths)
+
+
+# --------------------------------------- File Reaper ----------------------------------------- #
+
+file_reaper_queue = queue.Queue()
+file_reapers = []
+file_reapers_lock = threading.Lock()
+
+# where files were saved before content addressing, attachment_path points into them
+legacy_upload_folders = ('static/all_uploads/card_attachments/', 'static/all_uploads/card_cover_image/')
+
+
+def release_files(session, files):
+    # (attachment key, attachment path) of deleted attachments, reaped if the transaction commits
+    session.info.setdefault('released_files', set()).update(files)
+
+
+@event.listens_for(Session, 'after_commit')
+def reap_released_files(session):
+    files = session.info.pop('released_files', None)
+    if files:
+        start_file_reaper()
+        for file in files:
+            file_reaper_queue.put(file)
+
+
+@event.listens_for(Session, 'after_rollback')
+def keep_released_files(session):
+    session.info.pop('released_files', None)
+
+
+def start_file_reaper():
+    with file_reapers_lock:
+        if not file_reapers:
+            reaper = threading.Thread(target=reap_files_forever, daemon=True)
+            reaper.start()
+            file_reapers.append(reaper)
+
+
+def reap_files_forever():
+    while True:
+        files = [file_reaper_queue.get()]
+        while len(files) < app.config['FILE_REAPER_BATCH_SIZE']:
+            try:
+                files.append(file_reaper_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            reap_files(files)
+        except Exception as error:
+            app.logger.error(f'{len(files)} released files not deleted: {error}')
+
+
+def requeue_released_keys(keys):
+    for key in keys:
+        file_reaper_queue.put((key, None))
+
+
+def reap_files(files):
+    # a file stays while any attachment (a copied card...) still points at it, a missing file is already gone
+    keys = {key for key, _ in files if key}
+    paths = {path for key, path in files if not key}
+
+    with app.app_context():
+        if keys:
+            keys -= set(db.session.scalars(select(Attachment.attachment_key)
+                                           .where(Attachment.attachment_key.in_(keys))))
+        if paths:
+            paths -= set(db.session.scalars(select(Attachment.attachment_path)
+                                            .where(Attachment.attachment_path.in_(paths))))
+
+    # checked after the references: an upload reusing a key refreshes it before committing its attachment
+    fresh = time.time() - app.config['FILE_REAPER_GRACE']
+    reused = {key for key in keys if (attachment_storage.modified(key) or 0) > fresh}
+    if reused:
+        keys -= reused
+        retry = threading.Timer(app.config['FILE_REAPER_GRACE'], requeue_released_keys, args=(reused,))
+        retry.daemon = True
+        retry.start()
+
+    attachment_storage.delete_many([stored_key for key in keys for stored_key in
+                                    (key, *[image_variant_key(key, width)
+                                            for width in app.config['IMAGE_VARIANT_WIDTHS']])])
+    for path in paths:
+        try:
+            os.remove(path.lstrip('/'))
+        except FileNotFoundError:
+            pass
+
+
+@app.cli.command('sweep-uploads')
+@click.option('--dry-run', is_flag=True, help='Only list the orphaned files.')
+def sweep_uploads(dry_run):
+    """Delete stored files that no attachment points at."""
+    # younger files may belong to an upload whose attachment is not committed yet
+    settled = time.time() - app.config['ATTACHMENT_UPLOAD_TTL']
+    keys = set(db.session.scalars(select(Attachment.attachment_key).where(Attachment.attachment_key.is_not(None))))
+    paths = set(db.session.scalars(select(Attachment.attachment_path).where(Attachment.attachment_key.is_(None))))
+
+    orphan_keys = [key for key, modified in attachment_storage.keys()
+                   if modified < settled and original_key(key) not in keys]
+    orphan_paths = [os.path.join(folder, name) for folder in legacy_upload_folders if os.path.isdir(folder)
+                    for name in os.listdir(folder)
+                    if f'/{folder}{name}' not in paths and os.path.getmtime(os.path.join(folder, name)) < settled]
+
+    for orphan in [*orphan_keys, *orphan_paths]:
+        print(orphan)
+    if not dry_run:
+        attachment_storage.delete_many(orphan_keys)
+        for path in orphan_paths:
+            os.remove(path)
+        drop_stale_uploads()
+    print(f'{len(orphan_keys) + len(orphan_paths)} orphaned files{" found" if dry_run else " deleted"}')
+
+
+# --------------------------------------- Teardown ----------------------------------------- #
+
+
+def delete_card_rows(card_ids):
+    # items, attachments and cards in one DELETE each, the files are released to the reaper
+    release_files(db.session, db.session.execute(
+        select(Attachment.attachment_key, Attachment.attachment_path)
+        .where(Attachment.parent_card_id.in_(card_ids))).tuples().all())
+    db.session.execute(delete(ChecklistItem).where(ChecklistItem.parent_card_id.in_(card_ids)))
+    db.session.execute(delete(Attachment).where(Attachment.parent_card_id.in_(card_ids)))
+    db.session.execute(delete(Card).where(Card.card_id.in_(card_ids)))
+
+
+def delete_cards(criteria):
+    # every card matching criteria with everything in it, inside the caller's transaction
+    cards = db.session.execute(select(Card.card_id, List.parent_board_id).join(Card.parent_list)
+                               .where(criteria)).all()
+    if not cards:
+        return
+
+    delete_card_rows([card_id for card_id, _ in cards])
+    touch_boards(db.session, {board_id for _, board_id in cards})
+    for card_id, board_id in cards:
+        queue_board_event(db.session, board_id, {'type': 'card.deleted', 'id': card_id})
+
+
+def delete_list_rows(list_ids):
+    delete_card_rows(select(Card.card_id).where(Card.parent_list_id.in_(list_ids)))
+    db.session.execute(delete(List).where(List.list_id.in_(list_ids)))
+
+
+def delete_lists(criteria):
+    lists = db.session.execute(select(List.list_id, List.parent_board_id).where(criteria)).all()
+    if not lists:
+        return
+
+    delete_list_rows([list_id for list_id, _ in lists])
+    touch_boards(db.session, {board_id for _, board_id in lists})
+    for list_id, board_id in lists:
+        queue_board_event(db.session, board_id, {'type': 'list.deleted', 'id': list_id})
+
+
+def delete_boards(criteria):
+    # the whole tree top to bottom in one DELETE per table, whatever its size
+    # explicit rather than left to ON DELETE CASCADE, which sqlite only honours with foreign_keys on
+    board_ids = db.session.scalars(select(Board.board_id).where(criteria)).all()
+    if not board_ids:
+        return
+
+    delete_list_rows(select(List.list_id).where(List.parent_board_id.in_(board_ids)))
+    db.session.execute(delete(Board).where(Board.board_id.in_(board_ids)))
+    for board_id in board_ids:
+        queue_board_event(db.session, board_id, {'type': 'board.deleted', 'id': board_id})
+
+
+def delete_workspaces(criteria):
+    workspace_ids = db.session.scalars(select(Workspace.workspace_id).where(criteria)).all()
+    if not workspace_ids:
+        return
+
+    delete_boards(Board.parent_workspace_id.in_(workspace_ids))
+    db.session.execute(delete(Workspace).where(Workspace.workspace_id.in_(workspace_ids)))
+
 
 # --------------------------------------- Routes ----------------------------------------- #
 
@@ -612,6 +2441,7 @@ def login_page():
 
             else:
                 login_user(user)
+                session['password_stamp'] = password_stamp(user)
                 return redirect(url_for('boards_manager'))
 
     return render_template('login_page.html')
@@ -630,7 +2460,11 @@ def logout_page():
 
 @app.route('/reset_password', methods=['POST', 'GET'])
 def reset_password():
-    global otp_send, otp_confirmed, OTP, user_forgot_email
+    # the session only holds the token of the reset in progress, its email, otp digest and attempts are in the store
+    token = session.get('password_reset')
+    reset_key = f'password_reset:{token}'
+    reset = (token and state_store.get(reset_key)) or {}
+
     if request.method == 'POST':
         form_data = strip_form_data(request.form)
 
@@ -641,39 +2475,57 @@ def reset_password():
                     flash('email is not registered.')
 
                 else:
-                    send_otp(form_data['Email'])
-                    otp_send = True
-                    user_forgot_email = form_data['Email']
+                    token = send_otp(form_data['Email'])
+                    if token is None:
+                        flash('too many otp sent, try again later.')
+                    else:
+                        session['password_reset'] = token
+                        reset_key = f'password_reset:{token}'
+                        reset = state_store.get(reset_key) or {}
 
         elif 'reset_password' in request.form:
             if form_data['OTP'] != '':
-                if OTP != form_data['OTP']:
-                    flash('wrong otp entered.')
+                if not reset.get('otp'):
+                    flash('otp has expired, send a new one.')
+                elif not hmac.compare_digest(reset['otp'], otp_digest(form_data['OTP'])):
+                    # counted atomically, parallel guesses of one reset share the limit
+                    if state_store.incr(f'{reset_key}:attempts', app.config['OTP_TTL']) >= app.config['OTP_ATTEMPTS']:
+                        flash('too many wrong otp entered, send a new one.')
+                        state_store.delete(reset_key)
+                        reset = {}
+                    else:
+                        flash('wrong otp entered.')
                 else:
-                    otp_send = False
-                    otp_confirmed = True
+                    reset = {'email': reset['email'], 'otp': None, 'confirmed': True}
+                    state_store.set(reset_key, reset, app.config['OTP_TTL'])
 
         elif 'change_password' in request.form:
-            if form_data['New_Password'] != '' and form_data['Confirm-Password'] != '':
+            if not reset.get('confirmed'):
+                flash('otp has expired, send a new one.')
+
+            elif form_data['New_Password'] != '' and form_data['Confirm_Password'] != '':
                 if form_data['New_Password'] != form_data['Confirm_Password']:
                     flash('Password entries must be same.')
 
                 else:
-                    user = User.query.filter_by(user_email=user_forgot_email).first()
+                    user = User.query.filter_by(user_email=reset['email']).first()
                     user.user_password = generate_password_hash(form_data['New_Password'], method='pbkdf2:sha256',
                                                                 salt_length=8)
                     db.session.commit()
-                    otp_confirmed = False
+                    # signs out the sessions of the old password, other workers follow within USER_CACHE_TTL
+                    forget_user(user.id)
+                    state_store.delete(reset_key)
+                    session.pop('password_reset', None)
                     return redirect(url_for('login_page'))
 
-    return render_template('reset_password.html', email=user_forgot_email, otp_send=otp_send,
-                           otp_confirmed=otp_confirmed)
+    return render_template('reset_password.html', email=reset.get('email', ''), otp_send=bool(reset.get('otp')),
+                           otp_confirmed=bool(reset.get('confirmed')))
 
 
 @app.route('/boards_manager', methods=['GET', 'POST'])
 @login_required
 def boards_manager():
-    if len(Workspace.query.all()) == 0 and current_user.id == 1:
+    if current_user.id == 1 and not db.session.scalar(select(select(Workspace.workspace_id).exists())):
         template_workspace = Workspace()
         template_workspace.workspace_name = "Template"
         template_workspace.creator_id = 1
@@ -684,15 +2536,8 @@ def boards_manager():
 
         return redirect(url_for('boards_manager'))
 
-    random.shuffle(all_colors)
-    random.shuffle(all_images)
-    all_workspaces = Workspace.query.filter_by(creator_id=current_user.id).order_by(Workspace.workspace_id).all()
-    all_boards_recent = (Board.query.filter_by(creator_id=current_user.id, is_template=False)
-                         .order_by(desc(Board.board_recent_open_time)).all())
-
-    all_boards_added = Board.query.filter_by(creator_id=current_user.id, is_template=False).order_by(
-        desc(Board.board_added_date)).all()
-    all_templates = Board.query.filter_by(is_template=True).all()
+    bg_colors, bg_images = pick_backgrounds(6, 4)
+    all_workspaces, all_boards_recent, boards_by_workspace, all_templates = load_dashboard(current_user.id)
 
     if request.method == 'POST':
         form_data = strip_form_data(request.form)
@@ -765,38 +2610,32 @@ def boards_manager():
                 db.session.commit()
 
         if 'delete_workspace' in request.form:
-            workspace_to_delete = Workspace.query.filter_by(creator_id=current_user.id,
-                                                            workspace_id=int(request.form['Workspace_ID'])).first()
-            db.session.delete(workspace_to_delete)
+            delete_workspaces(and_(Workspace.creator_id == current_user.id,
+                                   Workspace.workspace_id == int(request.form['Workspace_ID'])))
             db.session.commit()
 
         if 'delete_board' in request.form:
-            board_to_delete = Board.query.filter_by(board_id=request.form['Board_Id']).first()
-            db.session.delete(board_to_delete)
+            delete_boards(and_(Board.creator_id == current_user.id, Board.board_id == int(request.form['Board_Id'])))
             db.session.commit()
 
         return redirect(url_for('boards_manager'))
 
-    return render_template('boards_manager.html', all_workspaces=all_workspaces, user=current_user,
-                           all_colors=all_colors, all_images=all_images, all_boards_recent=all_boards_recent,
-                           all_boards=all_boards_added, current_workspace_id=current_workspace_id,
-                           all_templates=all_templates)
+    return render_page('boards_manager.html', all_workspaces=all_workspaces, user=current_user,
+                       all_colors=bg_colors, all_images=bg_images, all_boards_recent=all_boards_recent,
+                       boards_by_workspace=boards_by_workspace,
+                       current_workspace_id=session.get('current_workspace_id'),
+                       all_templates=all_templates)
 
 
 @app.route('/board/<int:board_id>', methods=["POST", "GET"])
 @login_required
 def board(board_id):
-    global current_workspace_id
     one_board = Board.query.get(board_id)
-    one_board.board_recent_open_time = datetime.now()
-    db.session.commit()
+    track_board_open(board_id)
     all_workspaces = Workspace.query.filter_by(creator_id=current_user.id).order_by(Workspace.workspace_id).all()
-    all_lists = List.query.order_by(List.list_position).all()
-    all_cards = Card.query.order_by(Card.parent_list_id, Card.card_position).all()
-    all_items = ChecklistItem.query.all()
     all_boards = Board.query.filter_by(creator_id=current_user.id, is_template=False)
-    all_attachments = Attachment.query.order_by(Attachment.attachment_upload_date).all()
-    current_workspace_id = one_board.parent_workspace_id
+    # highlighted in the boards manager sidebar until another board is opened
+    session['current_workspace_id'] = one_board.parent_workspace_id
     all_lists_in_board = List.query.filter_by(parent_board_id=board_id)
 
     if request.method == 'POST':
@@ -808,8 +2647,7 @@ def board(board_id):
                 if all_lists_in_board.count() < 10:
                     new_list = List()
                     new_list.list_name = form_data['List_Name']
-                    # start list position with 1 for every new board
-                    new_list.list_position = all_lists_in_board.count() + 1
+                    new_list.list_rank = list_rank_at(board_id)
                     new_list.parent_board_id = board_id
                     new_list.creator_id = current_user.id
                     db.session.add(new_list)
@@ -824,9 +2662,7 @@ def board(board_id):
                     new_card = Card()
                     new_card.parent_list_id = request.form['List_Id']
                     new_card.card_name = form_data['Card_Name']
-                    # give position for each list
-                    # start position with 1 for every new list
-                    new_card.card_position = all_cards_in_list.count() + 1
+                    new_card.card_rank = card_rank_at(int(request.form['List_Id']))
                     new_card.creator_id = current_user.id
                     db.session.add(new_card)
                     db.session.commit()
@@ -858,156 +2694,70 @@ def board(board_id):
                     board_to_copy = Board.query.get(request.form['Board_Id'])
                     copy_board(id_=request.form['Board_Id'], board_name=form_data['Board_Name'],
                                workspace_id=request.form['Board_Workspace'],
-                               background=board_to_copy.board_background_image)
+                               background=board_to_copy.board_background_image, creator_id=current_user.id)
 
         if 'move_list_form' in request.form:
 
             if (request.form['Current_List_Position'] != request.form['Dest_Position_Move_List'] and
                     int(request.form['Dest_Board_Move_List']) == board_id):
 
-                x = 10000
-
-                current_list = List.query.filter_by(list_position=request.form['Current_List_Position'],
+                current_list = List.query.filter_by(list_position=int(request.form['Current_List_Position']),
                                                     parent_board_id=board_id).first()
-                current_list.list_position = x
-                db.session.commit()
-
-                increase_or_decrease_position(request.form['Current_List_Position'],
-                                              request.form['Dest_Position_Move_List'], board_id)
-
-                destination_list = List.query.filter_by(list_position=x, parent_board_id=board_id).first()
-                destination_list.list_position = int(request.form['Dest_Position_Move_List'])
+                current_list.list_rank = list_rank_at(board_id, int(request.form['Dest_Position_Move_List']),
+                                                      exclude_id=current_list.list_id)
                 db.session.commit()
 
             elif int(request.form['Dest_Board_Move_List']) != board_id:
 
-                all_lists_in_board = Board.query.filter_by(parent_board_id=request.form['Dest_Board_Move_List'])
+                all_lists_in_board = List.query.filter_by(parent_board_id=int(request.form['Dest_Board_Move_List']))
                 if all_lists_in_board.count() < 10:
 
-                    current_list = List.query.filter_by(list_position=request.form['Current_List_Position'],
+                    current_list = List.query.filter_by(list_position=int(request.form['Current_List_Position']),
                                                         parent_board_id=board_id).first()
 
-                    x = 10000
-                    current_list.list_position = x
+                    current_list.list_rank = list_rank_at(int(request.form['Dest_Board_Move_List']),
+                                                          int(request.form['Dest_Position_Move_List']))
                     current_list.parent_board_id = int(request.form['Dest_Board_Move_List'])
                     db.session.commit()
 
-                    all_lists_in_current_board = List.query.filter_by(parent_board_id=board_id)
-                    for i in range(int(request.form['Current_List_Position']) + 1,
-                                   int(all_lists_in_current_board.count()) + 2):
-                        list_to_edit = List.query.filter_by(list_position=i, parent_board_id=board_id).first()
-                        # 3, 4, 5
-                        list_to_edit.list_position = i - 1
-                        db.session.commit()
-
-                    all_lists_in_destination_board = List.query.filter_by(
-                        parent_board_id=int(request.form['Dest_Board_Move_List']))
-
-                    for i in range(-(int(all_lists_in_destination_board.count()) - 1),
-                                   -(int(request.form['Dest_Position_Move_List']) - 1)):
-                        i *= -1
-
-                        list_to_edit = List.query.filter_by(list_position=i,
-                                                            parent_board_id=int(
-                                                                request.form['Dest_Board_Move_List'])).first()
-                        list_to_edit.list_position = i + 1
-                        db.session.commit()
-
-                    destination_list = List.query.filter_by(list_position=x,
-                                                            parent_board_id=int(
-                                                                request.form['Dest_Board_Move_List'])).first()
-                    destination_list.list_position = request.form['Dest_Position_Move_List']
-                    db.session.commit()
-
         if 'copy_list_form' in request.form:
             if form_data['List_Name_Copy'] != '':
-                if all_lists_in_board < 10:
+                if all_lists_in_board.count() < 10:
                     list_to_copy = List.query.filter_by(list_id=int(request.form['Current_List_Id']),
                                                         parent_board_id=board_id).first()
 
-                    all_lists_in_destination_board = List.query.filter_by(parent_board_id=board_id)
-
-                    for i in range(-(int(all_lists_in_destination_board.count())),
-                                   -(int(request.form['Current_List_Position']))):
-                        i *= -1
-
-                        list_to_edit = List.query.filter_by(list_position=i, parent_board_id=board_id).first()
-                        list_to_edit.list_position = i + 1
-                        db.session.commit()
-
                     clone_list(list_to_copy.list_id, form_data['List_Name_Copy'])
 
         if 'delete_list_form' in request.form:
 
-            all_cards_in_current_list = Card.query.filter_by(parent_list_id=request.form['Current_List_Id'])
-
-            for card_to_delete in all_cards_in_current_list:
-
-                items_to_delete = ChecklistItem.query.filter_by(parent_card_id=card_to_delete.card_id)
-                attachments_to_delete = Attachment.query.filter_by(is_cover_image=False,
-                                                                   parent_card_id=card_to_delete.card_id)
-                cover_image_attachment = Attachment.query.filter_by(is_cover_image=True,
-                                                                    parent_card_id=card_to_delete.card_id).first()
-
-                if attachments_to_delete:
-                    for attachment in attachments_to_delete:
-                        os.remove(os.path.join(app.config['CARD_ATTACHMENTS'], attachment.attachment_name))
-                        db.session.delete(attachment)
-
-                    db.session.commit()
-
-                if cover_image_attachment:
-                    os.remove(os.path.join(app.config['CARD_COVER_IMAGE'], cover_image_attachment.attachment_name))
-
-                if items_to_delete:
-                    for i in items_to_delete:
-                        db.session.delete(i)
-                    db.session.commit()
-
-                db.session.delete(card_to_delete)
-                db.session.commit()
-
-            list_to_delete = List.query.filter_by(parent_board_id=board_id,
-                                                  list_id=request.form['Current_List_Id']).first()
-            db.session.delete(list_to_delete)
+            delete_lists(and_(List.parent_board_id == board_id, List.list_id == int(request.form['Current_List_Id'])))
             db.session.commit()
 
-            all_lists_in_board = List.query.filter_by(parent_board_id=board_id)
-
-            for i in range(int(request.form['Current_List_Position']) + 1,
-                           int(all_lists_in_board.count()) + 2):
-                list_to_edit = List.query.filter_by(list_position=i, parent_board_id=board_id).first()
-                list_to_edit.list_position = i - 1
-                db.session.commit()
-
         return redirect(url_for('board', board_id=board_id))
 
-    return render_template('board.html', all_boards=all_boards, one_board=one_board, all_lists=all_lists,
-                           all_cards=all_cards, all_attachments=all_attachments, all_colors=all_colors,
-                           all_images=all_images, current_workspace_id=current_workspace_id, user=current_user,
-                           all_workspaces=all_workspaces, all_items=all_items)
+    all_boards = all_boards.order_by(Board.board_id).all()
+    list_positions = load_list_positions(current_user.id, board_id)
+
+    return render_page('board.html', all_boards=all_boards, one_board=one_board,
+                       board_lists_chunks=board_lists_chunks(one_board, all_boards), list_positions=list_positions,
+                       board_version_etag=board_etag(one_board), all_colors=all_colors, all_images=background_images(),
+                       current_workspace_id=one_board.parent_workspace_id, user=current_user,
+                       all_workspaces=all_workspaces)
 
 
 @app.route('/card/<int:id_>/<int:card_id>', methods=['GET', 'POST'])
 @login_required
 def card(id_, card_id):
-    random.shuffle(all_colors)
-    random.shuffle(all_images)
-    all_items = ChecklistItem.query.order_by(ChecklistItem.item_id).all()
-    all_lists = List.query.order_by(List.list_position).all()
-    all_cards = Card.query.order_by(Card.parent_list_id, Card.card_position).all()
-    one_card = Card.query.get(card_id)
-    one_list = List.query.get(one_card.parent_list_id)
+    bg_colors, bg_images = pick_backgrounds(10, 6)
+    one_card = load_card(card_id)
+    one_list = one_card.parent_list
     one_board = Board.query.get(id_)
-    all_boards = Board.query.filter_by(is_template=False, parent_workspace_id=int(one_board.parent_workspace_id))
-    all_attachments = Attachment.query.order_by(Attachment.attachment_upload_date).all()
-    all_items_in_card = ChecklistItem.query.filter_by(parent_card_id=card_id)
-    completed_tasks = ChecklistItem.query.filter_by(item_status=True, parent_card_id=card_id).count()
+    card_items = one_card.card_checklist_items
 
-    if all_items_in_card.count() == 0 or completed_tasks is None:
+    if len(card_items) == 0:
         completed_task_perc = 0
     else:
-        completed_task_perc = round((completed_tasks / all_items_in_card.count()) * 100)
+        completed_task_perc = round(sum(item.item_status for item in card_items) / len(card_items) * 100)
 
     if request.method == 'POST':
         form_data = strip_form_data(request.form)
@@ -1047,55 +2797,30 @@ def card(id_, card_id):
                 if extension not in app.config['ALLOWED_EXTENSIONS_COVER_IMG']:
                     return '<h2>upload file with .jpg/.jpeg/.png/.gif extension only.</h2>'
 
-                file.save(os.path.join(app.config['CARD_COVER_IMAGE'], secure_filename(file.filename)))
-
-                new_attachment = Attachment()
-                new_attachment.attachment_name = file.filename
-                new_attachment.attachment_extension = extension
-                new_attachment.attachment_upload_date = datetime.now()
-                new_attachment.attachment_path = str(
-                    f"/{app.config['CARD_COVER_IMAGE'] + secure_filename(file.filename)}")
-                new_attachment.parent_card_id = card_id
-                new_attachment.is_cover_image = True
-                new_attachment.creator_id = current_user.id
-                db.session.add(new_attachment)
-                db.session.commit()
-
-                one_card.card_cover = str(f"/{app.config['CARD_COVER_IMAGE'] + secure_filename(file.filename)}")
+                # replaces the old cover attachment as well
+                save_attachment(one_card, file.filename, extension, store_upload(file.stream, extension),
+                                is_cover=True)
                 db.session.commit()
 
             else:
                 one_card.card_cover = request.form['cardCoverOption']
-                db.session.commit()
-
-            if old_attachment:
-                os.remove(os.path.join(app.config['CARD_COVER_IMAGE'], old_attachment.attachment_name))
-                db.session.delete(old_attachment)
+                if old_attachment:
+                    release_attachment(old_attachment)
                 db.session.commit()
 
             return redirect(url_for('card', id_=one_board.board_id, card_id=one_card.card_id))
 
         if 'card_attachment' in request.form:
-            all_attachments_in_card = Attachment.query.filter_by(parent_card_id=card_id)
-            if all_attachments_in_card < 5:
+            all_attachments_in_card = Attachment.query.filter_by(parent_card_id=card_id, is_cover_image=False)
+            if all_attachments_in_card.count() < 5:
                 file = request.files['Card_Attachment_File']
                 extension = os.path.splitext(file.filename)[1].lower()
 
                 if extension not in app.config['ALLOWED_EXTENSIONS_CARD_ATTACHMENT']:
                     return '<h2>The file is not supported in attachment.</h2>'
 
-                file.save(os.path.join(app.config['CARD_ATTACHMENTS'], secure_filename(file.filename)))
-
-                new_attachment = Attachment()
-                new_attachment.attachment_name = file.filename
-                new_attachment.attachment_extension = extension
-                new_attachment.attachment_upload_date = datetime.now()
-                new_attachment.attachment_path = str(
-                    f"/{app.config['CARD_ATTACHMENTS'] + secure_filename(file.filename)}")
-                new_attachment.parent_card_id = card_id
-                new_attachment.is_cover_image = False
-                new_attachment.creator_id = current_user.id
-                db.session.add(new_attachment)
+                save_attachment(one_card, file.filename, extension, store_upload(file.stream, extension),
+                                is_cover=False)
                 db.session.commit()
 
                 return redirect(url_for('card', id_=one_board.board_id, card_id=one_card.card_id))
@@ -1112,7 +2837,7 @@ def card(id_, card_id):
 
         if 'add_checklist_item' in request.form:
             if form_data['Item_Name'] != '':
-                if all_items_in_card.count() < 10:
+                if len(card_items) < 10:
                     new_item = ChecklistItem()
                     new_item.item_name = form_data['Item_Name']
                     new_item.item_status = False
@@ -1131,245 +2856,624 @@ def card(id_, card_id):
             attachment = Attachment.query.filter_by(attachment_id=request.form['attachment_id'],
                                                     parent_card_id=one_card.card_id).first()
 
-            os.remove(os.path.join(app.config['CARD_ATTACHMENTS'], attachment.attachment_name))
-            db.session.delete(attachment)
+            release_attachment(attachment)
             db.session.commit()
 
             return redirect(url_for('card', id_=one_board.board_id, card_id=one_card.card_id))
 
         if 'move_card_form' in request.form:
-            all_cards_in_dest_list = Card.query.filter_by(
-                parent_list_id=int(request.form['Dest_List_Move_Card'][1:]))
-            all_cards_in_current_list = Card.query.filter_by(
-                parent_list_id=int(request.form['Current_List_Id']))
+            dest_list_id = int(request.form['Dest_List_Move_Card'][1:])
+            all_cards_in_dest_list = Card.query.filter_by(parent_list_id=dest_list_id)
+
+            if request.form['Dest_Position_Move_Card'] == 'newPosition':
+                dest_position = None
+            else:
+                dest_position = int(request.form['Dest_Position_Move_Card'])
 
             # move card in same board
             if int(request.form['Dest_Board_Move_Card']) == one_board.board_id:
 
                 if (request.form['Current_Card_Position'] != request.form['Dest_Position_Move_Card'] and
-                        int(request.form['Dest_List_Move_Card'][1:]) == one_list.list_id):
+                        dest_list_id == one_list.list_id):
 
-                    x = 10000
+                    one_card.card_rank = card_rank_at(one_list.list_id, dest_position, exclude_id=one_card.card_id)
+                    db.session.commit()
 
-                    current_card = Card.query.filter_by(card_position=request.form['Current_Card_Position'],
-                                                        parent_list_id=request.form['Dest_List_Move_Card'][1:]).first()
+                elif dest_list_id != one_list.list_id:
 
-                    current_card.card_position = x
+                    one_card.card_rank = card_rank_at(dest_list_id, dest_position)
+                    one_card.parent_list_id = dest_list_id
                     db.session.commit()
 
-                    if request.form['Current_Card_Position'] < request.form['Dest_Position_Move_Card']:
+            elif int(request.form['Dest_Board_Move_Card']) != one_board.board_id:
+                if all_cards_in_dest_list.count() < 10:
 
-                        move_cards_up(int(request.form['Current_Card_Position']) + 1,
-                                      int(request.form['Dest_Position_Move_Card']) + 1,
-                                      int(request.form['Current_List_Id']))
+                    one_card.card_rank = card_rank_at(dest_list_id, dest_position)
+                    one_card.parent_list_id = dest_list_id
+                    db.session.commit()
 
-                    elif request.form['Current_Card_Position'] > request.form['Dest_Position_Move_Card']:
-                        # decrease position
+                    return redirect(url_for('board', board_id=one_board.board_id))
 
-                        move_cards_down(-(int(request.form['Current_Card_Position']) - 1),
-                                        -(int(request.form['Dest_Position_Move_Card']) - 1),
-                                        int(request.form['Current_List_Id']))
+        if 'copy_card_form' in request.form:
+            if form_data['Card_Name'] != '':
+                dest_list_id = int(request.form['Dest_List_Copy_Card'][1:])
+                all_cards_in_dest_list = Card.query.filter_by(parent_list_id=dest_list_id)
+                all_cards_in_current_list = Card.query.filter_by(
+                    parent_list_id=int(request.form['Current_List_Id']))
 
-                    destination_card = Card.query.filter_by(card_position=x, parent_list_id=one_list.list_id).first()
-                    destination_card.card_position = int(request.form['Dest_Position_Move_Card'])
-                    db.session.commit()
+                if request.form['Dest_Position_Copy_Card'] == 'newPosition':
+                    dest_position = None
+                else:
+                    dest_position = int(request.form['Dest_Position_Copy_Card'])
 
-                elif int(request.form['Dest_List_Move_Card'][1:]) != one_list.list_id:
+                if (int(request.form['Dest_Board_Copy_Card']) != one_board.board_id and
+                        all_cards_in_dest_list.count() < 10):
 
-                    if request.form['Dest_Position_Move_Card'] == 'newPosition':
+                    clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
+                               updated_parent_id=dest_list_id,
+                               updated_rank=card_rank_at(dest_list_id, dest_position))
 
-                        current_card = Card.query.filter_by(card_position=request.form['Current_Card_Position'],
-                                                            parent_list_id=one_list.list_id).first()
+                    return redirect(url_for('board', board_id=one_board.board_id))
 
-                        current_card.card_position = all_cards_in_dest_list.count() + 1
-                        current_card.parent_list_id = int(request.form['Dest_List_Move_Card'][1:])
-                        db.session.commit()
+                elif (all_cards_in_current_list.count() < 10 and
+                      request.form['Current_Card_Position'] != request.form['Dest_Position_Copy_Card'] and
+                      dest_list_id == one_list.list_id):
 
-                        move_cards_up(int(request.form['Current_Card_Position']) + 1,
-                                      int(all_cards_in_current_list.count() + 2),
-                                      one_list.list_id)
+                    clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
+                               updated_parent_id=one_list.list_id,
+                               updated_rank=card_rank_at(one_list.list_id, dest_position))
 
-                    elif request.form['Dest_Position_Move_Card'] != 'newPosition':
+                elif dest_list_id != one_list.list_id and all_cards_in_dest_list.count() < 10:
 
-                        x = 10000
+                    clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
+                               updated_parent_id=dest_list_id,
+                               updated_rank=card_rank_at(dest_list_id, dest_position))
 
-                        current_card = Card.query.filter_by(card_position=request.form['Current_Card_Position'],
-                                                            parent_list_id=one_list.list_id).first()
+        if 'checklist_item_checkbox' in request.form:
+            item_to_edit = ChecklistItem.query.filter_by(item_id=int(request.form['Item_Id'])).first()
+            item_to_edit.item_status = not item_to_edit.item_status
+            db.session.commit()
 
-                        current_card.card_position = x
-                        current_card.parent_list_id = int(request.form['Dest_List_Move_Card'][1:])
-                        db.session.commit()
+        if 'delete_checklist' in request.form:
 
-                        move_cards_up(int(request.form['Current_Card_Position']) + 1,
-                                      int(all_cards_in_current_list.count() + 2),
-                                      one_list.list_id)
+            for item in card_items:
+                db.session.delete(item)
+            db.session.commit()
 
-                        move_cards_down(-(int(all_cards_in_dest_list.count()) - 1),
-                                        -(int(request.form['Dest_Position_Move_Card']) - 1),
-                                        int(request.form['Dest_List_Move_Card'][1:]))
+            one_card.card_checklist_name = None
+            db.session.commit()
 
-                        destination_card = Card.query.filter_by(
-                            card_position=x,
-                            parent_list_id=request.form['Dest_List_Move_Card'][1:]).first()
-                        destination_card.card_position = int(request.form['Dest_Position_Move_Card'])
-                        db.session.commit()
+        if 'delete_checklist_item' in request.form:
+            item_to_delete = ChecklistItem.query.filter_by(parent_card_id=card_id,
+                                                           item_id=request.form['Item_Id']).first()
+            db.session.delete(item_to_delete)
+            db.session.commit()
 
-            elif int(request.form['Dest_Board_Move_Card']) != one_board.board_id:
-                if all_cards_in_dest_list.count() < 10:
-                    if request.form['Dest_Position_Move_Card'] == 'newPosition':
+        if 'delete_card' in request.form:
+            delete_cards(Card.card_id == one_card.card_id)
+            db.session.commit()
 
-                        current_card = Card.query.filter_by(card_position=request.form['Current_Card_Position'],
-                                                            parent_list_id=one_list.list_id).first()
+            return redirect(url_for('board', board_id=one_board.board_id))
 
-                        current_card.card_position = all_cards_in_dest_list.count() + 1
-                        current_card.parent_list_id = int(request.form['Dest_List_Move_Card'][1:])
-                        db.session.commit()
+        return redirect(url_for('card', id_=one_board.board_id, card_id=one_card.card_id))
 
-                        move_cards_up(int(request.form['Current_Card_Position']) + 1,
-                                      int(all_cards_in_current_list.count() + 2), one_list.list_id)
+    # the board behind the modal is the cached fragment of board(), the move/copy picker is fetched when opened
+    all_boards = (Board.query.filter_by(creator_id=current_user.id, is_template=False)
+                  .order_by(Board.board_id).all())
+    list_positions = load_list_positions(current_user.id, one_board.board_id)
 
-                    elif request.form['Dest_Position_Move_Card'] != 'newPosition':
+    return render_page('card.html', one_board=one_board, one_list=one_list, one_card=one_card,
+                       board_lists_chunks=board_lists_chunks(one_board, all_boards), list_positions=list_positions,
+                       all_colors=bg_colors, all_images=bg_images, card_attachments=one_card.card_attachments,
+                       card_items=card_items, completed_task_perc=completed_task_perc, user=current_user)
 
-                        x = 10000
 
-                        current_card = Card.query.filter_by(card_position=request.form['Current_Card_Position'],
-                                                            parent_list_id=one_list.list_id).first()
+# --------------------------------------- Attachment Downloads ----------------------------------------- #
 
-                        current_card.card_position = x
-                        current_card.parent_list_id = int(request.form['Dest_List_Move_Card'][1:])
-                        db.session.commit()
 
-                        move_cards_up(int(request.form['Current_Card_Position']) + 1,
-                                      int(all_cards_in_current_list.count() + 2), one_list.list_id)
+@app.route('/attachments/<key>')
+@login_required
+def attachment_file(key):
+    # any attachment with this content on a board the user can see, copies of a card share the file
+    attachment = (Attachment.query.join(Attachment.parent_card).join(Card.parent_list).join(List.parent_board)
+                  .filter(Attachment.attachment_key == key,
+                          or_(Board.creator_id == current_user.id, Board.is_template.is_(True)))
+                  .order_by(Attachment.attachment_id).first())
+    if attachment is None:
+        abort(404)
+
+    # images open in the page, anything else (.html...) is downloaded instead of rendered on this origin
+    as_attachment = attachment.attachment_extension not in app.config['ALLOWED_EXTENSIONS_COVER_IMG']
+    download_name = attachment.attachment_name
+    width = request.args.get('w', type=int)
+    variant_missing = False
+
+    if width in app.config['IMAGE_VARIANT_WIDTHS'] and has_image_variants(key):
+        if attachment_storage.exists(image_variant_key(key, width)):
+            key = image_variant_key(key, width)
+            download_name = os.path.splitext(download_name)[0] + '.webp'
+        else:
+            # the original until the variant is made, cached briefly so the variant replaces it
+            queue_image_variants(key)
+            variant_missing = True
+
+    response = attachment_storage.send(key, download_name, as_attachment)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if variant_missing:
+        response.cache_control.private = True
+        response.cache_control.max_age = 60
+    elif response.status_code in (200, 206, 304):
+        # private, the next viewer of a shared cache may not have access to the card
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = app.config['ATTACHMENT_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+# --------------------------------------- JSON API ----------------------------------------- #
+
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+
+def api_invalid(message):
+    # ends the request from inside a helper, like abort but with the api's json error
+    abort(make_response(api_error(message, 400)))
+
+
+def api_data():
+    data = request.get_json(silent=True)
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        api_invalid('the body must be a json object')
+    return data
+
+
+def api_board(board_id, write=False):
+    # the board's id and version only, enough to answer a conditional GET
+    # templates can be read by everyone, a board is only changed by its creator (the admin for templates)
+    one_board = (db.session.query(Board.board_id, Board.board_version, Board.creator_id, Board.is_template)
+                 .filter(Board.board_id == board_id).first())
+    if one_board is None:
+        abort(404)
+    if one_board.creator_id != current_user.id and not one_board.is_template:
+        abort(403)
+    if write and one_board.creator_id != current_user.id and current_user.id != 1:
+        abort(403)
+    return one_board
+
+
+def board_etag(one_board, *parts):
+    return '-'.join(str(part) for part in ('board', one_board.board_id, 'v', one_board.board_version, *parts))
+
+
+def not_modified(etag):
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def versioned(payload, etag, status=200):
+    response = jsonify(payload)
+    response.status_code = status
+    response.set_etag(etag)
+    return response
+
+
+def card_json(card_, badge=None):
+    # badge counts only where they were loaded, the board tree
+    return {'id': card_.card_id, 'name': card_.card_name, 'position': card_.card_position,
+            'list_id': card_.parent_list_id, 'due_date': card_.card_dueDate.isoformat() if card_.card_dueDate else None,
+            'cover': card_.card_cover, 'checklist_name': card_.card_checklist_name, **(badge or {})}
+
+
+def list_json(list_, card_badges):
+    no_badge = {'attachments': 0, 'items_done': 0, 'items_total': 0}
+    return {'id': list_.list_id, 'name': list_.list_name, 'position': list_.list_position,
+            'cards': [card_json(card_, card_badges.get(card_.card_id, no_badge)) for card_ in list_.list_cards]}
 
-                        move_cards_down(-(int(all_cards_in_dest_list.count()) - 1),
-                                        -(int(request.form['Dest_Position_Move_Card']) - 1),
-                                        int(request.form['Dest_List_Move_Card'][1:]))
 
-                        destination_card = Card.query.filter_by(
-                            card_position=x,
-                            parent_list_id=request.form['Dest_List_Move_Card'][1:]).first()
+def card_board(card_id, write=False):
+    # (card, board version row) of a card the user can see, or change with write
+    card_ = Card.query.get(card_id)
+    if card_ is None:
+        abort(404)
+    return card_, api_board(card_.parent_list.parent_board_id, write)
 
-                        destination_card.card_position = int(request.form['Dest_Position_Move_Card'])
-                        db.session.commit()
-                    return redirect(url_for('board', board_id=one_board.board_id))
 
-        if 'copy_card_form' in request.form:
-            print(request.form)
-            if form_data['Card_Name'] != '':
-                all_cards_in_dest_list = Card.query.filter_by(
-                    parent_list_id=int(request.form['Dest_List_Copy_Card'][1:]))
-                all_cards_in_current_list = Card.query.filter_by(
-                    parent_list_id=int(request.form['Current_List_Id']))
-                if (int(request.form['Dest_Board_Copy_Card']) != one_board.board_id and
-                        all_cards_in_dest_list.count() < 10):
+def api_id(data, name, default=None):
+    # a positive integer of the body (a number or its digits), None when it is not given
+    value = data.get(name, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not str(value).isdigit() or int(value) < 1:
+        api_invalid(f'{name} must be a positive integer')
+    return int(value)
 
-                    if request.form['Dest_Position_Copy_Card'] == 'newPosition':
 
-                        clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
-                                   updated_parent_id=request.form['Dest_List_Copy_Card'][1:],
-                                   updated_position=all_cards_in_dest_list.count() + 1)
+def api_text(data, name, max_length):
+    value = data[name]
+    if not isinstance(value, str) or value.strip() == '':
+        api_invalid(f'{name} must be a non empty string')
+    if len(value.strip()) > max_length:
+        api_invalid(f'{name} is limited to {max_length} characters')
+    return value.strip()
 
-                    elif request.form['Dest_Position_Copy_Card'] != 'newPosition':
-                        print('copy card to diff board and occ pos')
-                        move_cards_down(-int(all_cards_in_dest_list.count()),
-                                        -(int(request.form['Dest_Position_Copy_Card']) - 1),
-                                        int(request.form['Dest_List_Copy_Card'][1:]))
 
-                        clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
-                                   updated_parent_id=request.form['Dest_List_Copy_Card'][1:],
-                                   updated_position=request.form['Dest_Position_Copy_Card'])
+def api_position(data):
+    # 1-based place among the siblings, None puts the row last
+    return api_id(data, 'position')
 
-                    return redirect(url_for('board', board_id=one_board.board_id))
 
-                elif (all_cards_in_current_list.count() < 10 and
-                      request.form['Current_Card_Position'] != request.form['Dest_Position_Copy_Card'] and
-                      int(request.form['Dest_List_Copy_Card'][1:]) == one_list.list_id):
-                    print('copy in same list')
+def mutation_response(board_id, payload, status=200):
+    one_board = api_board(board_id)
+    return versioned({**payload, 'board_version': one_board.board_version}, board_etag(one_board), status)
 
-                    move_cards_down(-int(all_cards_in_current_list.count()),
-                                    -(int(request.form['Dest_Position_Copy_Card']) - 1),
-                                    int(request.form['Current_List_Id']))
 
-                    clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
-                               updated_parent_id=request.form['Current_List_Id'],
-                               updated_position=request.form['Dest_Position_Copy_Card'])
+@app.route('/api/v1/boards')
+@login_required
+def api_boards():
+    boards = (Board.query.filter_by(creator_id=current_user.id, is_template=False)
+              .order_by(Board.board_id).all())
+    return jsonify({'boards': [{'id': board_.board_id, 'name': board_.board_name, 'version': board_.board_version,
+                                'workspace_id': board_.parent_workspace_id, 'favorite': board_.board_favorite,
+                                'background': board_.board_background_image} for board_ in boards]})
 
-                elif (int(request.form['Dest_List_Copy_Card'][1:]) != one_list.list_id and
-                      all_cards_in_dest_list.count() < 10):
 
-                    if request.form['Dest_Position_Copy_Card'] == 'newPosition':
+@app.route('/api/v1/boards/<int:board_id>')
+@login_required
+def api_board_tree(board_id):
+    one_board = api_board(board_id)
+    etag = board_etag(one_board)
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
-                        clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
-                                   updated_parent_id=int(request.form['Dest_List_Copy_Card'][1:]),
-                                   updated_position=all_cards_in_dest_list.count() + 1)
+    board_ = Board.query.get(board_id)
+    card_badges = load_card_badges(board_id)
+    return versioned({'id': board_.board_id, 'name': board_.board_name, 'version': board_.board_version,
+                      'background': board_.board_background_image, 'favorite': board_.board_favorite,
+                      'lists': [list_json(list_, card_badges) for list_ in load_board_lists(board_id)]}, etag)
 
-                    elif request.form['Dest_Position_Copy_Card'] != 'newPosition':
 
-                        move_cards_down(-int(all_cards_in_dest_list.count()),
-                                        -(int(request.form['Dest_Position_Copy_Card']) - 1),
-                                        int(request.form['Dest_List_Copy_Card'][1:]))
+@app.route('/api/v1/cards/<int:card_id>')
+@login_required
+def api_card(card_id):
+    card_, one_board = card_board(card_id)
+    etag = board_etag(one_board, 'card', card_id)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    return versioned({**card_json(card_), 'description': card_.card_description,
+                      'items': [{'id': item.item_id, 'name': item.item_name, 'status': item.item_status}
+                                for item in card_.card_checklist_items],
+                      'attachments': [{'id': attachment.attachment_id, 'name': attachment.attachment_name,
+                                       'path': attachment.attachment_path, 'is_cover': attachment.is_cover_image}
+                                      for attachment in card_.card_attachments]}, etag)
+
+
+@app.route('/api/v1/boards/<int:board_id>/card-targets')
+@login_required
+def api_card_targets(board_id):
+    api_board(board_id, write=True)
+    return jsonify({'boards': load_card_targets(board_id)})
 
-                        clone_card(card_id=card_id, updated_name=form_data['Card_Name'],
-                                   updated_parent_id=int(request.form['Dest_List_Copy_Card'][1:]),
-                                   updated_position=int(request.form['Dest_Position_Copy_Card']))
 
-        if 'checklist_item_checkbox' in request.form:
-            item_to_edit = ChecklistItem.query.filter_by(item_id=int(request.form['Item_Id'])).first()
-            item_to_edit.item_status = not item_to_edit.item_status
-            db.session.commit()
+@app.route('/api/v1/boards/<int:board_id>/lists', methods=['POST'])
+@login_required
+def api_add_list(board_id):
+    api_board(board_id, write=True)
+    data = api_data()
+    if 'name' not in data:
+        return api_error('name is required', 400)
+    name = api_text(data, 'name', 25)
+    if List.query.filter_by(parent_board_id=board_id).count() >= 10:
+        return api_error('a board holds at most 10 lists', 409)
+
+    new_list = List(list_name=name, list_rank=list_rank_at(board_id), parent_board_id=board_id,
+                    creator_id=current_user.id)
+    db.session.add(new_list)
+    db.session.commit()
+    return mutation_response(board_id, {'id': new_list.list_id, 'position': new_list.list_position}, 201)
 
-        if 'delete_checklist' in request.form:
 
-            for item in all_items_in_card:
-                db.session.delete(item)
-            db.session.commit()
+@app.route('/api/v1/lists/<int:list_id>/cards', methods=['POST'])
+@login_required
+def api_add_card(list_id):
+    list_ = List.query.get_or_404(list_id)
+    api_board(list_.parent_board_id, write=True)
+    data = api_data()
+    if 'name' not in data:
+        return api_error('name is required', 400)
+    name = api_text(data, 'name', 20)
+    if Card.query.filter_by(parent_list_id=list_id).count() >= 10:
+        return api_error('a list holds at most 10 cards', 409)
+
+    new_card = Card(card_name=name, card_rank=card_rank_at(list_id), parent_list_id=list_id,
+                    creator_id=current_user.id)
+    db.session.add(new_card)
+    db.session.commit()
+    return mutation_response(list_.parent_board_id, card_json(new_card), 201)
 
-            one_card.card_checklist_name = None
-            db.session.commit()
 
-        if 'delete_checklist_item' in request.form:
-            item_to_delete = ChecklistItem.query.filter_by(parent_card_id=card_id,
-                                                           item_id=request.form['Item_Id']).first()
-            db.session.delete(item_to_delete)
-            db.session.commit()
+@app.route('/api/v1/lists/<int:list_id>/move', methods=['POST'])
+@login_required
+def api_move_list(list_id):
+    list_ = List.query.get_or_404(list_id)
+    api_board(list_.parent_board_id, write=True)
+    data = api_data()
+    board_id = api_id(data, 'board_id', list_.parent_board_id)
+    api_board(board_id, write=True)
+    if board_id != list_.parent_board_id and List.query.filter_by(parent_board_id=board_id).count() >= 10:
+        return api_error('a board holds at most 10 lists', 409)
+
+    list_.list_rank = list_rank_at(board_id, api_position(data), exclude_id=list_id)
+    list_.parent_board_id = board_id
+    db.session.commit()
+    return mutation_response(board_id, {'id': list_id, 'board_id': board_id, 'position': list_.list_position})
 
-        if 'delete_card' in request.form:
 
-            items_to_delete = ChecklistItem.query.filter_by(parent_card_id=card_id)
-            attachments_to_delete = Attachment.query.filter_by(is_cover_image=False, parent_card_id=card_id)
-            cover_image_attachment = Attachment.query.filter_by(is_cover_image=True, parent_card_id=card_id).first()
+@app.route('/api/v1/cards/<int:card_id>', methods=['PATCH'])
+@login_required
+def api_edit_card(card_id):
+    card_, one_board = card_board(card_id, write=True)
+    data = api_data()
+
+    if 'name' in data:
+        card_.card_name = api_text(data, 'name', 20)
+    if 'description' in data:
+        if data['description'] is not None and not isinstance(data['description'], str):
+            return api_error('description must be a string or null', 400)
+        if data['description'] and len(data['description']) > 500:
+            return api_error('description is limited to 500 characters', 400)
+        card_.card_description = data['description'] or None
+    if 'due_date' in data:
+        try:
+            card_.card_dueDate = datetime.strptime(data['due_date'], '%Y-%m-%d') if data['due_date'] else None
+        except (TypeError, ValueError):
+            return api_error('due_date must be a YYYY-MM-DD date or null', 400)
+    if 'checklist_name' in data:
+        card_.card_checklist_name = api_text(data, 'checklist_name', 20) if data['checklist_name'] else None
 
-            if attachments_to_delete:
-                for attachment in attachments_to_delete:
-                    os.remove(os.path.join(app.config['CARD_ATTACHMENTS'], attachment.attachment_name))
-                    db.session.delete(attachment)
+    db.session.commit()
+    return mutation_response(one_board.board_id, card_json(card_))
 
-                db.session.commit()
 
-            if cover_image_attachment:
-                os.remove(os.path.join(app.config['CARD_COVER_IMAGE'], cover_image_attachment.attachment_name))
+@app.route('/api/v1/cards/<int:card_id>/move', methods=['POST'])
+@login_required
+def api_move_card(card_id):
+    card_, one_board = card_board(card_id, write=True)
+    data = api_data()
+    dest_list = List.query.get_or_404(api_id(data, 'list_id', card_.parent_list_id))
+    api_board(dest_list.parent_board_id, write=True)
+    if (dest_list.list_id != card_.parent_list_id and
+            Card.query.filter_by(parent_list_id=dest_list.list_id).count() >= 10):
+        return api_error('a list holds at most 10 cards', 409)
+
+    card_.card_rank = card_rank_at(dest_list.list_id, api_position(data), exclude_id=card_id)
+    card_.parent_list_id = dest_list.list_id
+    db.session.commit()
+    return mutation_response(dest_list.parent_board_id, card_json(card_))
 
-            if items_to_delete:
-                for i in items_to_delete:
-                    db.session.delete(i)
-                db.session.commit()
 
-            db.session.delete(one_card)
-            db.session.commit()
+@app.route('/api/v1/cards/<int:card_id>/items', methods=['POST'])
+@login_required
+def api_add_item(card_id):
+    card_, one_board = card_board(card_id, write=True)
+    data = api_data()
+    if 'name' not in data:
+        return api_error('name is required', 400)
+    name = api_text(data, 'name', 15)
+    if ChecklistItem.query.filter_by(parent_card_id=card_id).count() >= 10:
+        return api_error('a checklist holds at most 10 items', 409)
+
+    new_item = ChecklistItem(item_name=name, item_status=False, parent_card_id=card_id, creator_id=current_user.id)
+    db.session.add(new_item)
+    db.session.commit()
+    return mutation_response(one_board.board_id, {'id': new_item.item_id, 'name': new_item.item_name,
+                                                  'status': new_item.item_status}, 201)
 
-            all_cards_in_current_list = Card.query.filter_by(parent_list_id=int(one_list.list_id))
 
-            move_cards_up(int(one_card.card_position) + 1, int(all_cards_in_current_list.count() + 2), one_list.list_id)
+@app.route('/api/v1/items/<int:item_id>', methods=['PATCH'])
+@login_required
+def api_edit_item(item_id):
+    item = ChecklistItem.query.get_or_404(item_id)
+    card_, one_board = card_board(item.parent_card_id, write=True)
+    data = api_data()
+
+    if 'status' in data:
+        if not isinstance(data['status'], bool):
+            return api_error('status must be true or false', 400)
+        item.item_status = data['status']
+    if 'name' in data:
+        item.item_name = api_text(data, 'name', 15)
 
-            return redirect(url_for('board', board_id=one_board.board_id))
+    db.session.commit()
+    return mutation_response(one_board.board_id, {'id': item.item_id, 'name': item.item_name,
+                                                  'status': item.item_status})
 
-        return redirect(url_for('card', id_=one_board.board_id, card_id=one_card.card_id))
 
-    return render_template('card.html', one_board=one_board, one_list=one_list, one_card=one_card,
-                           all_boards=all_boards, all_lists=all_lists, all_cards=all_cards, all_colors=all_colors,
-                           all_images=all_images, all_attachments=all_attachments, all_items=all_items,
-                           completed_task_perc=completed_task_perc, user=current_user)
+@app.route('/api/v1/items/<int:item_id>', methods=['DELETE'])
+@login_required
+def api_delete_item(item_id):
+    item = ChecklistItem.query.get_or_404(item_id)
+    card_, one_board = card_board(item.parent_card_id, write=True)
+    db.session.delete(item)
+    db.session.commit()
+    return mutation_response(one_board.board_id, {'id': item_id, 'deleted': True})
+
+
+# --------------------------------------- Resumable Uploads ----------------------------------------- #
+# POST creates an upload, PATCH appends the piece starting at its Upload-Offset header, HEAD tells how much of it
+# arrived after a dropped connection. The attachment is created by the PATCH that completes the file.
+
+
+def drop_stale_uploads():
+    expired = time.time() - app.config['ATTACHMENT_UPLOAD_TTL']
+    for name in os.listdir(os.path.dirname(staging_path(''))):
+        path = staging_path(name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_upload(upload_id):
+    # (metadata, path of the partial file) of an upload of the current user
+    if not upload_id.isalnum():
+        abort(404)
+    try:
+        with open(staging_path(f'{upload_id}.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+    except FileNotFoundError:
+        abort(404)
+    if metadata['creator_id'] != current_user.id:
+        abort(404)
+    return metadata, staging_path(f'{upload_id}.upload')
+
+
+def upload_offset_response(upload_id, metadata, offset, status=204):
+    response = app.response_class(status=status)
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(metadata['size'])
+    response.headers['Location'] = url_for('api_upload', upload_id=upload_id)
+    return response
+
+
+@app.route('/api/v1/cards/<int:card_id>/uploads', methods=['POST'])
+@login_required
+def api_start_upload(card_id):
+    card_, one_board = card_board(card_id, write=True)
+    data = api_data()
+    name = str(data.get('name', '')).strip()
+    is_cover = bool(data.get('cover'))
+    extension = os.path.splitext(name)[1].lower()
+    allowed = app.config['ALLOWED_EXTENSIONS_COVER_IMG' if is_cover else 'ALLOWED_EXTENSIONS_CARD_ATTACHMENT']
+
+    if extension not in allowed:
+        return api_error(f'allowed extensions are {", ".join(allowed)}', 400)
+    if len(name) > 300:
+        return api_error('name is limited to 300 characters', 400)
+    if (isinstance(data.get('size'), bool) or not isinstance(data.get('size'), int) or
+            not 0 < data['size'] <= app.config['ATTACHMENT_MAX_SIZE']):
+        return api_error(f'size must be between 1 and {app.config["ATTACHMENT_MAX_SIZE"]} bytes', 400)
+    if not is_cover and Attachment.query.filter_by(parent_card_id=card_id, is_cover_image=False).count() >= 5:
+        return api_error('a card holds at most 5 attachments', 409)
+
+    drop_stale_uploads()
+    upload_id = secrets.token_hex(16)
+    open(staging_path(f'{upload_id}.upload'), 'wb').close()
+    with open(staging_path(f'{upload_id}.json'), 'w') as metadata_file:
+        json.dump({'card_id': card_id, 'creator_id': current_user.id, 'name': name, 'extension': extension,
+                   'size': data['size'], 'is_cover': is_cover}, metadata_file)
+
+    return upload_offset_response(upload_id, {'size': data['size']}, 0, 201)
+
+
+@app.route('/api/v1/uploads/<upload_id>', methods=['HEAD'])
+@login_required
+def api_upload(upload_id):
+    metadata, path = load_upload(upload_id)
+    return upload_offset_response(upload_id, metadata, os.path.getsize(path))
+
+
+@app.route('/api/v1/uploads/<upload_id>', methods=['PATCH'])
+@login_required
+def api_append_upload(upload_id):
+    metadata, path = load_upload(upload_id)
+    offset = os.path.getsize(path)
+
+    if request.headers.get('Upload-Offset') != str(offset):
+        return upload_offset_response(upload_id, metadata, offset, 409)
+    if offset + (request.content_length or 0) > metadata['size']:
+        return api_error('the piece goes past the size of the upload', 400)
+
+    with open(path, 'ab') as partial:
+        while chunk := request.stream.read(app.config['ATTACHMENT_CHUNK_SIZE']):
+            if partial.tell() + len(chunk) > metadata['size']:
+                # a chunked body without Content-Length, the piece is dropped
+                partial.truncate(offset)
+                return api_error('the piece goes past the size of the upload', 400)
+            partial.write(chunk)
+        offset = partial.tell()
+
+    if offset < metadata['size']:
+        return upload_offset_response(upload_id, metadata, offset)
+
+    card_, one_board = card_board(metadata['card_id'], write=True)
+    os.remove(staging_path(f'{upload_id}.json'))
+    key = store_staged(path, file_digest(path), metadata['extension'])
+    new_attachment = save_attachment(card_, metadata['name'], metadata['extension'], key, metadata['is_cover'])
+    db.session.commit()
+
+    return mutation_response(one_board.board_id, {'id': new_attachment.attachment_id,
+                                                  'name': new_attachment.attachment_name,
+                                                  'path': new_attachment.attachment_path,
+                                                  'is_cover': new_attachment.is_cover_image}, 201)
+
+
+# --------------------------------------- Board Change Feed Stream ----------------------------------------- #
+
+
+@app.route('/board/<int:board_id>/events')
+@login_required
+def board_events(board_id):
+    api_board(board_id)
+    if not app.config['BOARD_EVENTS_STREAM']:
+        # 204 tells EventSource not to reconnect
+        return app.response_class(status=204)
+    subscription = board_event_broker.subscribe(board_id)
+
+    def stream():
+        # closed after a while so a thread is never held for the life of a tab, retry brings the browser back
+        deadline = time.monotonic() + app.config['BOARD_EVENTS_STREAM_TIMEOUT']
+        try:
+            yield 'retry: 3000\n\n'
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    event_ = subscription.get(timeout=min(15, remaining))
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: {event_["type"]}\ndata: {json.dumps(event_, default=str)}\n\n'
+        finally:
+            board_event_broker.unsubscribe(board_id, subscription)
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --------------------------------------- Health Check ----------------------------------------- #
+
+@app.route('/healthz')
+def healthz():
+    pool = db.engine.pool
+    # NullPool (DATABASE_PGBOUNCER) keeps no connections to count
+    stats = {name: getattr(pool, name)() for name in ('size', 'checkedin', 'checkedout', 'overflow')
+             if hasattr(pool, name)}
+    if 'overflow' in stats:
+        # negative while fewer than size connections were ever opened
+        stats['overflow'] = max(stats['overflow'], 0)
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        database = 'ok'
+    except Exception as error:
+        app.logger.error(f'health check failed: {error}')
+        database = 'unavailable'
+
+    response = jsonify({'database': database, 'pool': stats})
+    response.status_code = 200 if database == 'ok' else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
 # --------------------------------------- Catch error 413 ----------------------------------------- #
@@ -0,0 +1,114 @@
+import os
+import re
+import secrets
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# app.py reads its settings and static/ at import, it runs against a throwaway sqlite database
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}",
+                  SECRET_KEY=secrets.token_hex(16), UNSPLASH_ACCESS_KEY='test', ADMIN_EMAIL='admin@example.invalid')
+os.environ.pop('STATE_STORE_URL', None)
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import app as treliz  # noqa: E402
+
+ROUNDS = 20
+
+
+@pytest.fixture
+def mailed_otps(monkeypatch):
+    # codes are read from the mail instead of sent
+    otps = {}
+
+    def read_mail(sender, receivers, text):
+        otps[receivers] = re.search(r'Password\(OTP\):\n (\w+)', text).group(1)
+
+    monkeypatch.setattr(treliz, 'queue_mail', read_mail)
+    monkeypatch.setitem(treliz.app.config, 'OTP_SENDS', ROUNDS + 1)
+    return otps
+
+
+@pytest.fixture
+def users():
+    created = []
+    with treliz.app.app_context():
+        for _ in range(2):
+            password = secrets.token_urlsafe(12)
+            user = treliz.User(user_name='Isolation', user_email=f'{secrets.token_hex(6)}@example.invalid',
+                               user_password=treliz.generate_password_hash(password, method='pbkdf2:sha256',
+                                                                          salt_length=8),
+                               user_logo_color='grey')
+            workspace = treliz.Workspace(workspace_name='Isolation', workspace_logo_color='grey',
+                                         workspace_creator=user)
+            board = treliz.Board(board_name='Isolation', board_background_image='',
+                                 board_added_date=treliz.datetime.now(), board_creator=user,
+                                 parent_workspace=workspace)
+            treliz.db.session.add_all([user, workspace, board])
+            treliz.db.session.commit()
+            created.append({'id': user.id, 'email': user.user_email, 'password': password,
+                            'workspace_id': workspace.workspace_id, 'board_id': board.board_id})
+    return created
+
+
+def run_round(client, user, other, mailed_otps):
+    # one sign in, board visit and password reset, nothing of the other user may show up
+    assert client.post('/login', data={'Email': user['email'], 'Password': user['password']}).status_code == 302
+
+    for path in (f"/board/{user['board_id']}", '/boards_manager'):
+        response = client.get(path)
+        # board pages are streamed, closed here so their request context ends in this thread
+        response.close()
+        assert response.status_code == 200
+        with client.session_transaction() as client_session:
+            assert client_session.get('current_workspace_id') == user['workspace_id'], path
+
+    page = client.post('/reset_password', data={'Email': user['email'], 'send_otp': ''}).get_data(as_text=True)
+    assert other['email'] not in page
+    with client.session_transaction() as client_session, treliz.app.app_context():
+        reset = treliz.state_store.get(f"password_reset:{client_session['password_reset']}")
+    assert reset['email'] == user['email']
+
+    otp = mailed_otps[user['email']]
+    other_otp = mailed_otps.get(other['email'])
+    if other_otp and other_otp != otp:
+        page = client.post('/reset_password', data={'OTP': other_otp, 'reset_password': ''}).get_data(as_text=True)
+        assert 'Confirm_Password' not in page, "reset confirmed with the other user's otp"
+
+    page = client.post('/reset_password', data={'OTP': otp, 'reset_password': ''}).get_data(as_text=True)
+    assert 'Confirm_Password' in page, 'reset not confirmed with its own otp'
+
+    password = secrets.token_urlsafe(12)
+    response = client.post('/reset_password', data={'New_Password': password, 'Confirm_Password': password,
+                                                    'change_password': ''})
+    assert response.status_code == 302
+    user['password'] = password
+
+
+def test_two_users_in_parallel_keep_their_own_state(users, mailed_otps):
+    failures = []
+
+    def hammer(user, other):
+        client = treliz.app.test_client()
+        try:
+            for _ in range(ROUNDS):
+                run_round(client, user, other, mailed_otps)
+        except Exception as error:
+            failures.append(f"{user['email']}: {error!r}")
+
+    threads = [threading.Thread(target=hammer, args=(users[0], users[1])),
+               threading.Thread(target=hammer, args=(users[1], users[0]))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures
+
+    with treliz.app.app_context():
+        for user in users:
+            stored = treliz.db.session.get(treliz.User, user['id']).user_password
+            assert treliz.check_password_hash(pwhash=stored, password=user['password'])